@@ -1,14 +1,22 @@
 from __future__ import print_function, division
 import os
+import hashlib
 import logging
-import cPickle
+import time
+try:
+    import cPickle
+except ImportError:
+    import pickle as cPickle
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import numpy.polynomial.polynomial as poly
-from astropy.coordinates import SkyCoord
+import healpy as hp
 from astropy.table import Table, Column
-import astropy.units as u
-from lib.new_SM17 import SM
+from lib.SM2017 import SM, fk5_to_galactic
+from lib.catalogue import ChunkWriter
+from lib import timing
+from lib.timing import timed
 from astropy.utils.exceptions import AstropyWarning
 import warnings
 warnings.filterwarnings("ignore")
@@ -54,14 +62,177 @@ parser.add_argument('--out', dest='outfile', default=False, type=str,
 parser.add_argument('--fig', dest='figure', default=False,
                         help="Save Figure?")
 
+parser.add_argument('--cache', dest='cache_dir', default=None, type=str,
+                        help="Directory in which to cache the fitted source count model")
+
+parser.add_argument('--workers', dest='workers', default=1, type=int,
+                        help="Number of processes to run iterations on")
+parser.add_argument('--seed', dest='seed', default=None, type=int,
+                        help="Random seed, results are reproducible for a given seed regardless of --workers")
+
+parser.add_argument('--dump', dest='dump', default='csv', choices=['csv', 'fits', 'none'],
+                        help="Per source data: csv of the last iteration, fits of all iterations, or none")
+
+parser.add_argument('--timing', dest='timing', action='store_true', default=False,
+                        help="Log the time spent in each stage (in the main process only)")
+
 parser.add_argument('--version', action='version', version='%(prog)s 1.0')
 
-results = parser.parse_args()
-outfile=results.outfile
-class SIM(object):
-    def __init__(self, log=None):
 
+# Source count models that have already been fitted, keyed on (low, upp, freq, alpha, inc)
+_COUNT_MODELS = {}
+
+
+def franz_counts(mids):
+    a = [3.52, 0.307, -0.388, -0.0404, 0.0351, 0.006]
+    return 10 ** poly.polyval(np.log10(mids), a)
+
+
+def hopkins_counts(mids):
+    a = [0.859, 0.508, 0.376, -0.049, -0.121, 0.057, -0.008]
+    return 10 ** poly.polyval(np.log10(mids * 1e3), a)
+
+
+def linscale(freq, f0, low=50e-3, upp=1., alpha=-0.8, inc=1e-4):
+    edges = np.arange(low, upp, inc)
+    mids = (edges[1:] + edges[:-1]) / 2.
+    ds = np.diff(edges)
+    return mids, ds, edges
+
+
+def fran_gen(freq=185e6, alpha=-0.8, inc=1e-4):
+    f0 = 154e6
+    low = 1e-3
+    upp = 75.
+    fr = ((freq * 1.0) / f0) ** (alpha)
+    stats = linscale(freq, f0, low, upp, alpha, inc / fr)
+    mid, ds, edg = stats
+    counts = franz_counts(mid)
+    numcounts = counts * ds * mid ** (-2.5)
+    return mid * fr, numcounts, np.sum(numcounts), fr
+
+
+def hop_gen(freq=185e6, alpha=-0.8, inc=1e-4):
+    f0 = 1400e6
+    low = 0.05e-3
+    upp = 1.
+    fr = ((freq * 1.0) / f0) ** (alpha)
+    stats = linscale(freq, f0, low, upp, alpha, inc / fr)
+    mid, ds, edg = stats
+    counts = hopkins_counts(mid)
+    numcounts = counts * ds * mid ** (-2.5)
+    return mid * fr, numcounts, np.sum(numcounts), fr
+
+
+def weight(freq=185e6, alpha=-0.8, inc=1e-4):
+    fmid, fcounts, ftotal, fratio = fran_gen(freq, alpha=alpha, inc=inc)
+    hmid, hcounts, htotal, hratio = hop_gen(freq, alpha=alpha, inc=inc)
+    f0_f = 154e6
+    f0_h = 1400e6
+    # WEIGHTING
+    dF = np.abs(freq - f0_f)
+    dH = np.abs(freq - f0_h)
+    fw1 = 1. - (np.abs(dF) / (dF + dH))
+    fw2 = 1. - (np.abs(dH) / (dF + dH))
+    if freq <= 154e6:
+        mids = np.array(fmid)
+        ncounts = np.array(fcounts)
+    elif freq >= 1400e6:
+        mids = np.array(hmid)
+        ncounts = np.array(hcounts)
+    else:
+        franz_upp = np.max(fmid)
+        franz_low = np.min(fmid)
+        hop_low = np.min(hmid)
+        hop_upp = np.max(hmid)
+
+        # OVERLAP
+        maskff = np.where((fmid >= hop_low) & (fmid <= hop_upp))
+        maskhh = np.where((hmid >= franz_low) & (hmid <= franz_upp))
+        m1 = (fmid[maskff] * fw1) + (hmid[maskhh] * fw2)
+        n1 = (fcounts[maskff] * fw1) + (hcounts[maskhh] * fw2)
+        # OUTER EDGES
+        maskf1 = np.where(fmid < hop_low)
+        m2 = fmid[maskf1]
+        n2 = fcounts[maskf1]
+        maskf2 = np.where(fmid > hop_upp)
+        m4 = fmid[maskf2]
+        n4 = fcounts[maskf2]
+
+        maskh1 = np.where(hmid < franz_low)
+        m3 = hmid[maskh1]
+        n3 = hcounts[maskh1]
+        maskh2 = np.where(hmid > franz_upp)
+        m5 = hmid[maskh2]
+        n5 = hcounts[maskh2]
+
+        ncounts = np.concatenate([n2, n3, n1, n4, n5])
+        mids = np.concatenate([m2, m3, m1, m4, m5])
+        mids = np.array(mids)
+        ncounts = np.array(ncounts)
+
+    return mids, ncounts, np.sum(ncounts), fmid, hmid, fcounts, hcounts, ftotal, htotal
+
+
+def limit(low, upp, freq=185e6, alpha=-0.8, inc=1e-4):
+    mids, ncounts, tcounts, fmid, hmid, fcounts, hcounts, ftotal, htotal = weight(freq, alpha, inc)
+    x = np.log10(mids)
+    y = np.log10(ncounts)
+    deg = 15
+    z = poly.polyfit(x, y, deg=deg)
+    x0 = np.arange(low, upp, inc)
+    x0 = np.log10(x0)
+    p = 10 ** poly.polyval(x0, z)
+    x0 = 10 ** x0
+    mids, edges = x0[:-1] + inc, x0
+    ncounts = p[:-1]
+    return mids, ncounts, np.sum(ncounts), edges
+
+
+@timed('HaVS.count_model')
+def count_model(low, upp, freq=185e6, alpha=-0.8, inc=1e-4, cache_dir=None):
+    """
+    Fit the source count model for the given parameters, or return the one that was fitted earlier.
+    The model is the same for every iteration of a run, so it is kept in memory, and optionally
+    saved to cache_dir so that later runs with the same parameters can skip the fit.
+    Input:  Flux limits (Jy), frequency (Hz), spectral index, bin size (Jy), cache directory
+    Output: bin mids, source counts per bin (per steradian), total counts, bin edges
+    """
+    key = (float(low), float(upp), float(freq), float(alpha), float(inc))
+    if key in _COUNT_MODELS:
+        return _COUNT_MODELS[key]
+    cache_file = None
+    if cache_dir is not None:
+        # name the file from the exact parameter values, so that nearby values don't share a file
+        name = hashlib.sha1(repr(key).encode('ascii')).hexdigest()
+        cache_file = os.path.join(cache_dir, 'counts_{0}.npz'.format(name))
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as f:
+                model = f['mids'], f['ncounts'], float(f['total']), f['edges']
+            _COUNT_MODELS[key] = model
+            return model
+    model = limit(low, upp, freq, alpha, inc)
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        mids, ncounts, total, edges = model
+        # write to a temporary file and move it into place, so other processes never see a partial file
+        tmp = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, mids=mids, ncounts=ncounts, total=total, edges=edges)
+            os.replace(tmp, cache_file)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    _COUNT_MODELS[key] = model
+    return model
+
+
+class SIM(object):
+    def __init__(self, log=None, options=None):
 
+        if options is None:
+            options = results
         if log is None:
             logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
             self.log = logging.getLogger("SIM_new")
@@ -69,267 +240,173 @@ class SIM(object):
         else:
             self.log=log
         #Variables
-        self.figure=results.figure
-        self.nu = np.float(results.nu) * 1e6 #Hz, Default 185 MHz
+        self.figure=options.figure
+        self.nu = float(options.nu) * 1e6 #Hz, Default 185 MHz
         self.arcsec = np.pi / (180. * 3600.)
-        self.mod_cutoff = np.float(results.mc) #Default 0.05
-        self.low_Flim = np.float(results.FLL)  # Jy, Default 50e-3 Jy
-        self.upp_Flim = np.float(results.FUL) # Jy, Default 1 Jy
-        self.region_name = results.region_name
-        region=cPickle.load(open(self.region_name, 'rb'))
-        self.area = region.get_area(degrees=True)
-        self.obs_time = np.float(results.obs_time) * 24. * 60. * 60. # seconds, Default 183 days
-        self.loops=np.int(results.loops) #Default 20
+        self.mod_cutoff = float(options.mc) #Default 0.05
+        self.low_Flim = float(options.FLL)  # Jy, Default 50e-3 Jy
+        self.upp_Flim = float(options.FUL) # Jy, Default 1 Jy
+        self.region_name = options.region_name
+        self.region = self.load_region(self.region_name)
+        self.area = self.region.get_area(degrees=True)
+        self.obs_time = float(options.obs_time) * 24. * 60. * 60. # seconds, Default 183 days
+        self.loops=int(options.loops) #Default 20
         self.num_scale=40
-        self.a=np.float(results.a) #Default 3300
-        self.map=float(results.map)
+        self.a=float(options.a) #Default 3300
+        self.map=float(options.map)
         self.alpha=-0.8
+        self.cache_dir = options.cache_dir
+        self.workers = options.workers
+        self.seed = options.seed
+        self.dump = options.dump
+        if options.timing:
+            timing.enable()
+        self.rng = np.random.default_rng(self.seed)
         if self.map==1:
             self.ha_file = 'Ha_map_new.fits'
             self.err_file = 'Ha_err_new.fits'
         elif self.map==0:
             self.ha_file = 'Halpha_map.fits'
             self.err_file = 'Halpha_error.fits'
+        # one SM is shared by every iteration (and copied once to each worker)
+        start = time.time()
+        self.sm = SM(ha_file=os.path.join(datadir, self.ha_file),
+                     err_file=os.path.join(datadir, self.err_file),
+                     nu=self.nu,
+                     log=self.log)
+        self.sm_setup_time = time.time() - start
 
         #self.scount=float(results.scount)
 
+    @timed('HaVS.flux_gen', size=lambda out: out[1])
     def flux_gen(self):
         """
         Function to distribute flux across all points
         Input:  Flux Density limit, RA/DEC positions, source distribution function
         Output: Flux for each RA/DEC point
         """
-
-        def franz_counts(mids):
-            a = [3.52, 0.307, -0.388, -0.0404, 0.0351, 0.006]
-            source_counts = []
-            for ii in range(0, len(mids)):
-                x = (mids[ii])
-                sum_counts = 0.
-                for i in range(0, 6):
-                    sum_counts = sum_counts + (a[i] * (np.log10(x)) ** i)
-                sum_counts = 10 ** (sum_counts)
-                source_counts.append(sum_counts)
-            return (source_counts)
-
-        def hopkins_counts(mids):
-            a = [0.859, 0.508, 0.376, -0.049, -0.121, 0.057, -0.008]
-            source_counts = []
-            mids = mids * 1e3
-            for ii in range(0, len(mids)):
-                x = (mids[ii])
-                sum_counts = 0.
-                for i in range(0, 7):
-                    sum_counts = sum_counts + (a[i] * (np.log10(x)) ** i)
-                sum_counts = 10 ** (sum_counts)
-                source_counts.append(sum_counts)
-            return (source_counts)
-
-        def linscale(freq, f0, low=50e-3, upp=1., alpha=-0.8, inc=1e-4):
-            edges = np.arange(low, upp, inc)
-            mids = []
-            ds = []
-            for i in range(0, len(edges) - 1):
-                mids.append((edges[i + 1] + edges[i]) / 2.)
-                ds.append(edges[i + 1] - edges[i])
-            mids = np.array(mids)
-            ds = np.array(ds)
-            return mids, ds, edges
-
-        def fran_gen(freq=185e6, alpha=-0.8, inc=1e-4):
-            f0 = 154e6
-            low = 1e-3
-            upp = 75.
-            fr = ((freq * 1.0) / f0) ** (alpha)
-            stats = linscale(freq, f0, low, upp, alpha, inc / fr)
-            mid, ds, edg = stats
-            counts = franz_counts(mid)
-            numcounts = counts * ds * mid ** (-2.5)
-            return mid * fr, numcounts, np.sum(numcounts), fr
-
-        def hop_gen(freq=185e6, alpha=-0.8, inc=1e-4):
-            f0 = 1400e6
-            low = 0.05e-3
-            upp = 1.
-            fr = ((freq * 1.0) / f0) ** (alpha)
-            stats = linscale(freq, f0, low, upp, alpha, inc / fr)
-            mid, ds, edg = stats
-            counts = hopkins_counts(mid)
-            numcounts = counts * ds * mid ** (-2.5)
-            return mid * fr, numcounts, np.sum(numcounts), fr
-
-        def weight(freq=185e6, alpha=-0.8, inc=1e-4):
-            fmid, fcounts, ftotal, fratio = fran_gen(freq, alpha=alpha, inc=inc)
-            hmid, hcounts, htotal, hratio = hop_gen(freq, alpha=alpha, inc=inc)
-            f0_f = 154e6
-            f0_h = 1400e6
-            # WEIGHTING
-            dF = np.abs(freq - f0_f)
-            dH = np.abs(freq - f0_h)
-            fw1 = 1. - (np.abs(dF) / (dF + dH))
-            fw2 = 1. - (np.abs(dH) / (dF + dH))
-            if freq <= 154e6:
-                mids = np.array(fmid)
-                ncounts = np.array(fcounts)
-            elif freq >= 1400e6:
-                mids = np.array(hmid)
-                ncounts = np.array(hcounts)
-            else:
-                franz_upp = np.max(fmid)
-                franz_low = np.min(fmid)
-                hop_low = np.min(hmid)
-                hop_upp = np.max(hmid)
-
-                # OVERLAP
-                maskff = np.where((fmid >= hop_low) & (fmid <= hop_upp))
-                maskhh = np.where((hmid >= franz_low) & (hmid <= franz_upp))
-                m1 = (fmid[maskff] * fw1) + (hmid[maskhh] * fw2)
-                n1 = (fcounts[maskff] * fw1) + (hcounts[maskhh] * fw2)
-                # OUTER EDGES
-                maskf1 = np.where(fmid < hop_low)
-                m2 = fmid[maskf1]
-                n2 = fcounts[maskf1]
-                maskf2 = np.where(fmid > hop_upp)
-                m4 = fmid[maskf2]
-                n4 = fcounts[maskf2]
-
-                maskh1 = np.where(hmid < franz_low)
-                m3 = hmid[maskh1]
-                n3 = hcounts[maskh1]
-                maskh2 = np.where(hmid > franz_upp)
-                m5 = hmid[maskh2]
-                n5 = hcounts[maskh2]
-
-                ncounts = np.concatenate([n2, n3, n1, n4, n5])
-                mids = np.concatenate([m2, m3, m1, m4, m5])
-                mids = np.array(mids)
-                ncounts = np.array(ncounts)
-
-            return mids, ncounts, np.sum(ncounts), fmid, hmid, fcounts, hcounts, ftotal, htotal
-
-        def limit(low, upp, freq=185e6, alpha=-0.8, inc=1e-4):
-            mids, ncounts, tcounts, fmid, hmid, fcounts, hcounts, ftotal, htotal = weight(freq, alpha, inc)
-            x = np.log10(mids)
-            y = np.log10(ncounts)
-            xf = np.log10(fmid)
-            yf = np.log10(fcounts)
-            xh = np.log10(hmid)
-            yh = np.log10(hcounts)
-            deg = 15
-            z = poly.polyfit(x, y, deg=deg)
-            zf = poly.polyfit(xf, yf, deg=deg)
-            zh = poly.polyfit(xh, yh, deg=deg)
-            x0 = np.arange(low, upp, inc)
-            x0 = np.log10(x0)
-            p = 10 ** poly.polyval(x0, z)
-            pf = 10 ** poly.polyval(x0, zf)
-            ph = 10 ** poly.polyval(x0, zh)
-            x0 = 10 ** x0
-            mids, edges, fmid, hmid = x0[:-1] + inc, x0, x0[:-1] + inc, x0[:-1] + inc
-            ncounts, fcounts, hcounts = p[:-1], pf[:-1], ph[:-1]
-            return mids, ncounts, np.sum(ncounts), edges
-
-        mids, norm_counts, total_counts, edges= limit(self.low_Flim, self.upp_Flim, self.nu, self.alpha)
+        mids, norm_counts, total_counts, edges = count_model(self.low_Flim, self.upp_Flim, self.nu, self.alpha,
+                                                             cache_dir=self.cache_dir)
         Area = self.area * (np.pi ** 2.) / (180. ** 2.)
-        FLUX = []
         num_sources = norm_counts * Area
-        tcounts = total_counts * Area
-        for i in range(0, len(edges) - 1):
-            count = num_sources[i]
-            p = count - int(count)
-            leftover_count = np.random.choice([0, 1], p=[1 - p, p])
-            count = int(count) + leftover_count
-            FLUX.extend(np.random.uniform(edges[i], edges[i + 1], size=int(count)))
-        flux_arr = np.random.permutation(np.array(FLUX))
+        # whole number of sources in each bin, plus one more with probability equal to the fractional part
+        counts = np.floor(num_sources).astype(np.int64)
+        counts += self.rng.uniform(size=len(counts)) < (num_sources - counts)
+        # fluxes are uniformly distributed within each bin
+        lower = np.repeat(edges[:-1], counts)
+        width = np.repeat(np.diff(edges), counts)
+        flux_arr = self.rng.permutation(lower + width * self.rng.uniform(size=len(lower)))
         return flux_arr, len(flux_arr)
 
-    def pos_gen(self):
+    @timed('HaVS.pos_gen', size=lambda out: len(out[0]))
+    def pos_gen(self, num=None, lrange=(0., 360.), brange=(-90., 90.)):
         """
-        A function to generate a number of random points in RA/DEC
-        Input:  Number of points to generate from flux_gen function
-        Output: List of RA/DEC (2,1) array in (2D) Cartesian coordiantes.
+        A function to generate a number of random points uniformly distributed on the sky
+        Points are uniform in l and sin(b), optionally restricted to a bounding box
+        Input:  Number of points to generate (default from flux_gen function), l/b bounding box in degrees
+        Output: l, b arrays in degrees
         """
-
-        num_sources=self.flux_gen()[1]
-        num=num_sources*200.
-        lim = int(num)
-        x = []
-        y = []
-        z = []
-        r = []
-        i = 0
-        #Generating cube
-        x1 = np.array(np.random.uniform(-1.0, 1.0, lim))
-        y1 = np.array(np.random.uniform(-1.0, 1.0, lim))
-        z1 = np.array(np.random.uniform(-1.0, 1.0, lim))
-        rad = (x1 ** 2.0 + y1 ** 2.0 + z1 ** 2.0) ** (0.5)
-        #Getting points inside sphere of radius 1
-        for i in range(0, len(rad)):
-            if rad[i] <= 1.:
-                x.append(x1[i])
-                y.append(y1[i])
-                z.append(z1[i])
-                r.append(rad[i])
-        x, y, z = np.array(x) / np.array(r), np.array(y) / np.array(r), np.array(z) / np.array(r)
-        r0 = (x ** 2.0 + y ** 2.0 + z ** 2.0) ** 0.5
-        #converting back to cartesian cooridantes
-        theta = np.arccos(z / r0) * 180 / np.pi
-        theta = theta - 90.
-        theta = theta
-        phi = np.arctan2(y, x) * 180. / (np.pi)
-        phi = phi + 180.
-        phi = phi
-        return np.array(phi), np.array(theta)
-
-    def region_gen(self, reg_file):
+        if num is None:
+            num = self.flux_gen()[1]
+        l = self.rng.uniform(lrange[0], lrange[1], int(num))
+        sinb = self.rng.uniform(np.sin(np.radians(brange[0])), np.sin(np.radians(brange[1])), int(num))
+        b = np.degrees(np.arcsin(sinb))
+        return l, b
+
+    def load_region(self, reg_file):
         """
-        Takes in a list of positions and removes points outside the MIMAS region
-        Input:  RA/DEC positions and MIMAS region file.
-        Output: List of RA/DEC inside the correct region.
+        Load a MIMAS region and prepare it for sampling
+        The region is a set of HEALPix pixels, so membership is tested by looking up the pixel
+        of each position in the (sorted) pixel list. A ra/dec bounding box is also calculated
+        so that positions can be drawn close to the region.
+        Input:  MIMAS region file
+        Output: MIMAS region
         """
+        with open(reg_file, 'rb') as f:
+            region = cPickle.load(f)
+        self.region_nside = 2 ** region.maxdepth
+        self.region_pix = np.sort(np.fromiter(region.get_demoted(), dtype=np.int64))
+        theta, phi = hp.pix2ang(self.region_nside, self.region_pix, nest=True)
+        ra = np.degrees(phi)
+        dec = 90. - np.degrees(theta)
+        pad = np.degrees(hp.max_pixrad(self.region_nside))
+        dec_lo = max(-90., np.min(dec) - pad)
+        dec_hi = min(90., np.max(dec) + pad)
+        # the ra range is everything except the biggest gap between pixel centres (which may wrap through 0)
+        ra = np.unique(ra)
+        gaps = np.diff(np.append(ra, ra[0] + 360.))
+        big = np.argmax(gaps)
+        max_dec = max(abs(dec_lo), abs(dec_hi))
+        ra_pad = pad / np.cos(np.radians(max_dec)) if max_dec < 90. else 360.
+        if gaps[big] <= 2 * ra_pad:
+            ra_lo, ra_hi = 0., 360.
+        else:
+            ra_lo = ra[(big + 1) % len(ra)] - ra_pad
+            ra_hi = ra_lo + 360. - gaps[big] + 2 * ra_pad
+        self.region_box = (ra_lo, ra_hi, dec_lo, dec_hi)
+        return region
 
-        # reg_ra = []
-        # reg_dec = []
-        # region = cPickle.load(open(reg_file, 'rb'))
-        # flux, num=self.flux_gen()
-        # while len(reg_ra) < num:
-        #     RA, DEC = self.pos_gen()
-        #     reg_arr = region.sky_within(RA, DEC, degin=True)
-        #     reg_ra.extend(RA[reg_arr])
-        #     reg_dec.extend(DEC[reg_arr])
+    def in_region(self, ra, dec):
+        """
+        Test if positions are within the region
+        Input:  RA/DEC positions in degrees
+        Output: boolean array
+        """
+        pix = hp.ang2pix(self.region_nside, np.radians(90. - dec), np.radians(ra), nest=True)
+        idx = np.clip(np.searchsorted(self.region_pix, pix), 0, len(self.region_pix) - 1)
+        return self.region_pix[idx] == pix
 
+    @timed('HaVS.region_gen', size=lambda out: out[3])
+    def region_gen(self, reg_file=None):
+        """
+        Generates positions that are uniformly distributed within the MIMAS region
+        Positions are drawn within the bounding box of the region and those outside are rejected.
+        Input:  MIMAS region file (default is the region given on the command line)
+        Output: galactic l/b inside the correct region, flux, and number of sources
+        """
+        if reg_file is not None and reg_file != self.region_name:
+            self.region_name = reg_file
+            self.region = self.load_region(reg_file)
+            self.area = self.region.get_area(degrees=True)
+        flux, num = self.flux_gen()
+        if num == 0:
+            return np.zeros(0), np.zeros(0), flux, num
+        ra_lo, ra_hi, dec_lo, dec_hi = self.region_box
+        box_area = np.radians(ra_hi - ra_lo) * (np.sin(np.radians(dec_hi)) - np.sin(np.radians(dec_lo)))
+        box_area *= (180. / np.pi) ** 2
         reg_ra = []
         reg_dec = []
-        region = cPickle.load(open(reg_file, 'rb'))
-        flux, num = self.flux_gen()
-        while len(reg_ra) < num:
-            RA, DEC = self.pos_gen()
-            c = SkyCoord(l=RA*u.degree, b=DEC*u.degree, frame='galactic')
-            ra=c.fk5.ra.deg
-            dec=c.fk5.dec.deg
-            reg_arr = region.sky_within(ra, dec, degin=True)
-            print(max(RA), max(DEC))
-            #for i in range(0, len(reg_arr)):
-            reg_ra.extend(RA[reg_arr])
-            reg_dec.extend(DEC[reg_arr])
-        print(max(reg_ra), max(reg_dec))
-        reg_dec= np.array(reg_dec[:num])
-        reg_ra = np.array(reg_ra[:num])
-        return reg_ra, reg_dec, flux, num
-
+        found = 0
+        while found < num:
+            # draw enough points that we expect to fill the region, with a little to spare
+            draw = int((num - found) * 1.1 * box_area / self.area) + 1
+            ra, dec = self.pos_gen(draw, lrange=(ra_lo, ra_hi), brange=(dec_lo, dec_hi))
+            ra = ra % 360.
+            inside = self.in_region(ra, dec)
+            reg_ra.append(ra[inside])
+            reg_dec.append(dec[inside])
+            found += np.sum(inside)
+        ra = np.concatenate(reg_ra)[:num]
+        dec = np.concatenate(reg_dec)[:num]
+        # the rest of the simulation works in galactic coordinates
+        l, b = fk5_to_galactic(ra, dec)
+        return l, b, flux, num
+
+    @timed('HaVS.stype_gen', size=lambda out: len(out[0]))
     def stype_gen(self):
         """
         Function to determine if a source is of type compact or extended
         Input:  RA/DEC list (source_size?)
         Output: compact (1?) or extended (0?)
         """
-        ra,dec,flux=self.region_gen(self.region_name)[0:3]
+        ra,dec,flux=self.region_gen()[0:3]
         arr=ra
 
-        stype_arr=(np.random.choice(stypes, p=sprobs, size=len(arr)))
+        stype_arr=(self.rng.choice(stypes, p=sprobs, size=len(arr)))
 
         return stype_arr, ra, dec, flux
 
+    @timed('HaVS.ssize_gen', size=lambda out: len(out[0]))
     def ssize_gen(self):
         """
         Generates source size based stype given.
@@ -356,6 +433,7 @@ class SIM(object):
         return ssize_arr, stype, ra, dec ,flux
 
 
+    @timed('HaVS.output_gen', size=lambda out: len(out[0]))
     def output_gen(self):
         """
         Function to use SM2017 to get Modulation, Timescale, Halpha, Theta and other values.
@@ -364,18 +442,11 @@ class SIM(object):
 
         """
         ssize, stype, ra, dec ,flux=self.ssize_gen()
-        nu = np.float(self.nu)
-        frame = 'galactic'
-        #frame='fk5'
         tab = Table()
 
-        # create the sky coordinate
-        pos = SkyCoord(ra * u.degree, dec * u.degree, frame=frame)
-        # make the SM object
-
-        sm = SM(ha_file=os.path.join(datadir, self.ha_file),
-                err_file=os.path.join(datadir, self.err_file),
-                nu=nu)
+        # the positions are already galactic l/b, so resolve them without a SkyCoord
+        sm = self.sm
+        pos = sm.resolve_lb(ra, dec)
         # Halpha
         Ha, err_Ha = sm.get_halpha(pos)
         # xi
@@ -397,9 +468,11 @@ class SIM(object):
         #tau, err_tau=sm.get_tau(pos)
         tau=1
         err_tau=1
-        print(max(m))
+        if len(m):
+            print(max(m))
         return m, err_m, t0, err_t0, Ha, err_Ha , theta, err_theta, tau, err_tau,ssize, stype, ra, dec ,flux
 
+    @timed('HaVS.areal_gen', size=lambda out: len(out[5]))
     def areal_gen(self):
         """
         Function to generate the areal sky density (ASD) values
@@ -412,14 +485,15 @@ class SIM(object):
 
         mod, err_m, t0, err_t0, Ha, err_Ha, theta, err_theta, tau, err_tau,ssize, stype, RA, DEC ,flux= self.output_gen()
         obs_yrs = self.obs_time / (3600. * 24. * 365.25)
-        t_mask=np.where(np.float(obs_yrs)<=t0)
-        mod[t_mask] = mod[t_mask] * (np.float(obs_yrs)/ t0[t_mask])
-        err_m[t_mask] = err_m[t_mask] * (np.float(obs_yrs) / t0[t_mask])
+        t_mask=np.where(float(obs_yrs)<=t0)
+        mod[t_mask] = mod[t_mask] * (float(obs_yrs)/ t0[t_mask])
+        err_m[t_mask] = err_m[t_mask] * (float(obs_yrs) / t0[t_mask])
 
         #mp = np.random.normal(loc=mod, scale=err_m)
-        print(np.max(mod))
-        mp= np.random.uniform(low=mod-err_m, high= mod+err_m)
-        print(np.max(mp))
+        mp= self.rng.uniform(low=mod-err_m, high= mod+err_m)
+        if len(mod):
+            print(np.max(mod))
+            print(np.max(mp))
         v_mask=np.where(mp*flux>=self.low_Flim*3.)
         m_mask=np.where(mp>=self.mod_cutoff)
         var_mask=np.where((mp*flux>=self.low_Flim*3.) & (mp>=self.mod_cutoff))
@@ -434,9 +508,10 @@ class SIM(object):
         varareal=float(varcount)/ self.area
         print(mcount, vcount, varcount)
 
+        # the per source data are written out by repeat, according to self.dump
+        if self.dump == 'none':
+            return varareal, mp, t0, Ha, theta, flux, mareal, vareal, varareal,ssize, stype, RA, DEC ,flux, None
         datatab1 = Table()
-        mvar=int(self.map)
-        datafile = self.region_name[8:-4] + '_test_19' +'_m{0}_data.csv'.format(mvar)
         #print('mod_mean',np.mean(mod))
         ### DATA FILE
         datatab1.add_column(Column(data=RA, name='RA'))
@@ -452,8 +527,35 @@ class SIM(object):
         datatab1.add_column(Column(data=err_theta, name='Theta err'))
         #datatab1.add_column(Column(data=tau, name='Tau'))
         #datatab1.add_column(Column(data=err_tau, name='Tau err'))
-        datatab1.write(datafile, overwrite=True)
-        return varareal, mp, t0, Ha, theta, flux, mareal, vareal, varareal,ssize, stype, RA, DEC ,flux
+        return varareal, mp, t0, Ha, theta, flux, mareal, vareal, varareal,ssize, stype, RA, DEC ,flux, datatab1
+
+    def iteration(self, seed):
+        """
+        Run one iteration of the ASD calculation with its own random number generator
+        Input: numpy.random.SeedSequence
+        Output: as for areal_gen
+        """
+        self.rng = np.random.default_rng(seed)
+        return self.areal_gen()
+
+    def iterations(self):
+        """
+        Run all of the iterations, in a process pool if there is more than one worker
+        Input: Number of iterations and random seed set at beginning
+        Output: generator of areal_gen outputs, in iteration order
+        """
+        # each iteration gets its own independent random stream, so the results don't depend on the number of workers
+        seeds = np.random.SeedSequence(self.seed).spawn(self.loops)
+        if self.workers > 1:
+            # fit the source count model once here, rather than once in every worker
+            count_model(self.low_Flim, self.upp_Flim, self.nu, self.alpha, cache_dir=self.cache_dir)
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                     initargs=(self, dict(_COUNT_MODELS))) as pool:
+                for output in pool.map(_run_iteration, seeds):
+                    yield output
+        else:
+            for seed in seeds:
+                yield self.iteration(seed)
 
     def repeat(self):
         """
@@ -469,9 +571,18 @@ class SIM(object):
         NSources = []
         count = 0
 
-        for i in range(0, self.loops):
-            INPUT = self.areal_gen()
-            varareal, mp, t0, Ha, theta, flux, mareal, vareal, varareal, ssize, stype, RA, DEC, flux = INPUT
+        # per source data from all iterations are streamed into one file, or only the last iteration is kept
+        writer = None
+        mvar = int(self.map)
+        datafile = self.region_name[8:-4] + '_test_19' + '_m{0}_data.{1}'.format(mvar, self.dump)
+        if self.dump == 'fits':
+            writer = ChunkWriter(datafile)
+
+        for i, INPUT in enumerate(self.iterations()):
+            varareal, mp, t0, Ha, theta, flux, mareal, vareal, varareal, ssize, stype, RA, DEC, flux, datatab1 = INPUT
+            if writer is not None:
+                datatab1.add_column(Column(data=np.full(len(datatab1), i), name='Iteration'), index=0)
+                writer.write(datatab1)
             areal_arr.append(INPUT[0])
             mod_arr[i,:]=[np.mean(INPUT[1]), np.std(INPUT[1])]
             t0_arr[i,:]=[np.mean(INPUT[2]), np.std(INPUT[2])]
@@ -479,12 +590,33 @@ class SIM(object):
             theta_arr[i,:]=[np.mean(INPUT[4]), np.std(INPUT[4])]
             count=count+1
             NSources.append(len(INPUT[1]))
+        if writer is not None:
+            writer.close()
+        elif self.dump == 'csv':
+            datatab1.write(datafile, overwrite=True)
         areal_arr = np.array(areal_arr)
         NSources = np.array(NSources)
+        self.log.info("SM setup took {0:.3f}s, shared by {1} iterations".format(self.sm_setup_time, self.loops))
+        if timing.enabled():
+            timing.log_report(self.log)
 
         return areal_arr, mod_arr,t0_arr, Ha_arr, theta_arr, count, NSources, self.area, self.low_Flim, self.upp_Flim, self.obs_time, self.nu, self.mod_cutoff,ssize, stype, RA, DEC ,flux
 
 
+# The SIM instance used by each worker process in SIM.repeat
+_WORKER_SIM = None
+
+
+def _init_worker(sim, models):
+    global _WORKER_SIM
+    _WORKER_SIM = sim
+    _COUNT_MODELS.update(models)
+
+
+def _run_iteration(seed):
+    return _WORKER_SIM.iteration(seed)
+
+
 def test():
     """
     This section collects runs the previous functions and outputs them to two different files.
@@ -541,4 +673,7 @@ def test():
         print("Avg Source Size: {0}".format(np.round(np.mean(ssize),5)))
 
 
-test()
+if __name__ == "__main__":
+    results = parser.parse_args()
+    outfile = results.outfile
+    test()
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Helpers shared by the benchmark scripts.
+The Hα maps in data/ are large, so benchmarks run against synthetic maps that are
+generated on the fly with the same projection (galactic plate carrée).
+"""
+
+import os
+import sys
+import resource
+import numpy as np
+
+# make the repo importable when running as `python bench/<script>.py`
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if REPO not in sys.path:
+    sys.path.insert(0, REPO)
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+
+def make_maps(directory, nx=4096, ny=2048, seed=0):
+    """
+    Write a synthetic Hα map and error map in galactic CAR projection.
+    :param directory: output directory
+    :param nx: number of pixels in longitude
+    :param ny: number of pixels in latitude
+    :param seed: random seed
+    :return: ha_file, err_file
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    ha_file = os.path.join(directory, 'Halpha_map.fits')
+    err_file = os.path.join(directory, 'Halpha_error.fits')
+    if os.path.exists(ha_file) and os.path.exists(err_file):
+        return ha_file, err_file
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['GLON-CAR', 'GLAT-CAR']
+    wcs.wcs.crval = [0., 0.]
+    wcs.wcs.crpix = [nx / 2. + 0.5, ny / 2. + 0.5]
+    wcs.wcs.cdelt = [-360. / nx, 180. / ny]
+    header = wcs.to_header()
+    rng = np.random.RandomState(seed)
+    b = (np.arange(ny) - ny / 2.) * 180. / ny
+    # bright plane plus noise, always positive
+    data = (1. + 50. * np.exp(-(b / 10.) ** 2))[:, None] + rng.uniform(0, 1, size=(ny, nx))
+    data = data.astype(np.float32)
+    fits.PrimaryHDU(data, header=header).writeto(ha_file, overwrite=True)
+    fits.PrimaryHDU(0.1 * data, header=header).writeto(err_file, overwrite=True)
+    return ha_file, err_file
+
+
+def random_lb(n, seed=0):
+    """
+    Uniformly distributed positions on the sky.
+    :param n: number of positions
+    :param seed: random seed
+    :return: l, b in degrees
+    """
+    rng = np.random.RandomState(seed)
+    l = rng.uniform(0., 360., n)
+    b = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+    return l, b
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of this process in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kB elsewhere
+    if sys.platform == 'darwin':
+        return rss / 2. ** 20
+    return rss / 2. ** 10
@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Compare the old (list of tuples) and new (contiguous arrays) pixel lookup in SM.get_halpha,
+and the bilinear/bicubic interpolated sampling.
+Each (path, size) combination runs in a fresh process so that peak RSS is meaningful.
+
+usage: python bench/halpha_lookup.py [--sizes 10000 1000000 10000000] [--paths old new bilinear bicubic]
+                                     [--out results.json]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import make_maps, random_lb, peak_rss_mb
+from lib.SM2017 import SM, interpolate
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+
+def old_lookup(sm, l, b):
+    """
+    The pixel lookup as it was before the array version
+    """
+    x, y = zip(*sm.wcs.all_world2pix(list(zip(l, b)), 0))
+    x = np.int64(np.floor(x))
+    x = np.clip(x, 0, sm.hdu['NAXIS1'] - 1)
+    y = np.int64(np.floor(y))
+    y = np.clip(y, 0, sm.hdu['NAXIS2'] - 1)
+    return sm.data[y, x], sm.err_data[y, x]
+
+
+def new_lookup(sm, l, b):
+    x, y = sm._get_pixels(l, b)
+    return sm.data[y, x], sm.err_data[y, x]
+
+
+def interp_lookup(sm, l, b):
+    x, y = sm.wcs.all_world2pix(l, b, 0)
+    return tuple(interpolate([sm.data, sm.err_data], x, y, sm.interp))
+
+
+def run_one(path, n, mapdir):
+    """
+    Time a single lookup and report as json on stdout
+    """
+    ha_file, err_file = make_maps(mapdir)
+    sm = SM(ha_file, err_file, interp=path if path in ('bilinear', 'bicubic') else 'nearest')
+    l, b = random_lb(n)
+    # touch the maps so that page faults aren't counted against either path
+    sm.data.sum()
+    sm.err_data.sum()
+    before = peak_rss_mb()
+    func = {'old': old_lookup, 'new': new_lookup}.get(path, interp_lookup)
+    start = time.time()
+    func(sm, l, b)
+    wall = time.time() - start
+    print(json.dumps({'path': path, 'n': n, 'wall_s': wall,
+                      'peak_rss_mb': peak_rss_mb(), 'rss_growth_mb': peak_rss_mb() - before}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', dest='sizes', nargs='+', type=int, default=[10 ** 4, 10 ** 6, 10 ** 7],
+                        help='Number of positions to look up')
+    parser.add_argument('--paths', dest='paths', nargs='+', default=['old', 'new'],
+                        help='Which lookup paths to run [old, new, bilinear, bicubic]')
+    parser.add_argument('--out', dest='outfile', default=None,
+                        help='Write results to this json file')
+    parser.add_argument('--worker', dest='worker', nargs=3, default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        path, n, mapdir = options.worker
+        run_one(path, int(n), mapdir)
+        return
+
+    mapdir = tempfile.mkdtemp()
+    make_maps(mapdir)
+    results = []
+    print("{0:>8} {1:>10} {2:>10} {3:>14} {4:>14}".format('path', 'n', 'wall (s)', 'peak RSS (MB)', 'growth (MB)'))
+    for n in options.sizes:
+        for path in options.paths:
+            out = subprocess.check_output([sys.executable, __file__, '--worker', path, str(n), mapdir])
+            res = json.loads(out.decode().strip().splitlines()[-1])
+            results.append(res)
+            print("{path:>8} {n:>10d} {wall_s:>10.3f} {peak_rss_mb:>14.1f} {rss_growth_mb:>14.1f}".format(**res))
+    if options.outfile:
+        with open(options.outfile, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Measure the start up time of the command line tools.
+Each command is run several times in a fresh interpreter and the median wall time is reported,
+along with the slowest imports (cumulative time) from python -X importtime.
+
+usage: python bench/startup.py [--repeat 5] [--top 10] [--out results.json]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from common import REPO
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+COMMANDS = [('varcalc --help', ['varcalc.py', '--help']),
+            ('varcalc (usage)', ['varcalc.py']),
+            ('import lib.SM2017', ['-c', 'import lib.SM2017']),
+            ('import lib.SM2017 + SM', ['-c', 'from lib.SM2017 import SM; import astropy.io.fits, astropy.wcs'])]
+
+
+def wall_time(args, repeat):
+    """
+    :return: median wall time in seconds to run python with the given arguments
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable] + args, cwd=REPO, stdout=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+
+def import_times(args, top):
+    """
+    :return: list of (module, cumulative seconds) for the slowest top level imports
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=REPO,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # only report the imports made directly by the command, not their dependencies
+        if not name[1:].startswith(' '):
+            modules.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(modules, key=lambda x: -x[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='Number of times to run each command')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help='Number of imports to report for each command')
+    parser.add_argument('--out', dest='outfile', default=None,
+                        help='Write results to this json file')
+    options = parser.parse_args()
+
+    results = []
+    for name, args in COMMANDS:
+        res = {'command': name, 'wall_s': wall_time(args, options.repeat),
+               'imports': import_times(args, options.top)}
+        results.append(res)
+        print("{0:>24} {1:>8.3f}s".format(name, res['wall_s']))
+        for module, cumulative in res['imports'][:3]:
+            print("{0:>24} {1:>8.3f}s {2}".format('', cumulative, module))
+    if options.outfile:
+        with open(options.outfile, 'w') as f:
+            json.dump({'python': sys.version, 'results': results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
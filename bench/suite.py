@@ -0,0 +1,179 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Benchmarks for the SM2017 hot paths, run against synthetic Hα/error maps.
+Each (case, size) combination runs in a fresh process so that peak RSS is meaningful.
+Results are written as json along with the versions of the main dependencies,
+so that runs before and after an upgrade can be compared.
+
+cases:
+    halpha   SM.get_halpha
+    m        SM.get_m
+    rms      SM.get_rms_var
+    vo       SM.get_vo
+    varcalc  varcalc.py table mode (read fits, --all, write fits)
+    havs     one HaVS iteration, with a region sized to give about n sources
+             (skipped if healpy or AegeanTools are not installed)
+
+usage: python bench/suite.py [--cases halpha m rms vo varcalc havs] [--sizes 1000 100000 1000000]
+                             [--nx 4096] [--ny 2048] [--out results.json]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from common import REPO, make_maps, random_lb, peak_rss_mb
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+CASES = ['halpha', 'm', 'rms', 'vo', 'varcalc', 'havs']
+
+
+def versions():
+    """
+    :return: dict of the versions of python and the main dependencies
+    """
+    result = {'python': platform.python_version(), 'platform': platform.platform()}
+    for name in ['numpy', 'scipy', 'astropy', 'healpy', 'AegeanTools']:
+        try:
+            module = __import__(name)
+            result[name] = getattr(module, '__version__', 'unknown')
+        except ImportError:
+            result[name] = None
+    return result
+
+
+def bench_getter(name, n, mapdir):
+    """
+    Time one of the SM.get_* methods on n random positions
+    """
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+    from lib.SM2017 import SM
+    ha_file, err_file = make_maps(mapdir)
+    sm = SM(ha_file, err_file)
+    l, b = random_lb(n)
+    pos = SkyCoord(l * u.degree, b * u.degree, frame='galactic')
+    func = {'halpha': sm.get_halpha, 'm': sm.get_m, 'rms': sm.get_rms_var, 'vo': sm.get_vo}[name]
+    start = time.time()
+    func(pos)
+    return {'wall_s': time.time() - start}
+
+
+def bench_varcalc(n, mapdir):
+    """
+    Time varcalc table mode: read a catalogue, calculate everything, write the result
+    """
+    from astropy.table import Table
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+    from lib.SM2017 import SM
+    import varcalc
+    ha_file, err_file = make_maps(mapdir)
+    l, b = random_lb(n)
+    fk5 = SkyCoord(l * u.degree, b * u.degree, frame='galactic').fk5
+    infile = os.path.join(mapdir, 'cat_{0}.fits'.format(n))
+    outfile = os.path.join(mapdir, 'out_{0}.fits'.format(n))
+    Table({'ra': fk5.ra.degree, 'dec': fk5.dec.degree}).write(infile, overwrite=True)
+    options = argparse.Namespace(cols=('ra', 'dec'), append=False, workers=1)
+    for dest, _ in varcalc.COLUMNS:
+        setattr(options, dest, True)
+    start = time.time()
+    sm = SM(ha_file, err_file, log=varcalc.log)
+    tab = varcalc.process_table(Table.read(infile), sm, options, 'fk5')
+    tab.write(outfile, overwrite=True)
+    return {'wall_s': time.time() - start}
+
+
+def bench_havs(n, mapdir):
+    """
+    Time a single HaVS iteration over a circular region that should contain about n sources
+    """
+    try:
+        import healpy
+        from AegeanTools.regions import Region
+    except ImportError:
+        return {'skipped': 'healpy and AegeanTools are required'}
+    import HaVS
+    make_maps(mapdir)
+    HaVS.datadir = mapdir
+    options = HaVS.parser.parse_args(['-reg', '', '-i', '1', '--seed', '0', '--dump', 'none'])
+    # size the region from the source density
+    _, _, total, _ = HaVS.count_model(float(options.FLL), float(options.FUL), float(options.nu) * 1e6, -0.8)
+    area = min(4 * np.pi, n / total)  # sr
+    radius = np.arccos(max(-1., 1. - area / (2 * np.pi)))
+    region = Region(maxdepth=8)
+    region.add_circles(np.radians(100.), np.radians(-30.), radius)
+    options.region_name = os.path.join(mapdir, 'region_{0}.mim'.format(n))
+    region.save(options.region_name)
+    sim = HaVS.SIM(log=HaVS.logging.getLogger('bench'), options=options)
+    start = time.time()
+    output = sim.iteration(np.random.SeedSequence(0))
+    return {'wall_s': time.time() - start, 'sources': len(output[5]), 'region_deg2': float(sim.area)}
+
+
+def run_one(case, n, mapdir):
+    """
+    Run a single benchmark and report as json on stdout
+    """
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    if case == 'varcalc':
+        res = bench_varcalc(n, mapdir)
+    elif case == 'havs':
+        res = bench_havs(n, mapdir)
+    else:
+        res = bench_getter(case, n, mapdir)
+    res.update({'case': case, 'n': n, 'peak_rss_mb': peak_rss_mb()})
+    print(json.dumps(res))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cases', dest='cases', nargs='+', default=CASES, choices=CASES,
+                        help='Which benchmarks to run [all]')
+    parser.add_argument('--sizes', dest='sizes', nargs='+', type=int, default=[10 ** 3, 10 ** 5, 10 ** 6],
+                        help='Number of positions/sources')
+    parser.add_argument('--nx', dest='nx', type=int, default=4096, help='Synthetic map width')
+    parser.add_argument('--ny', dest='ny', type=int, default=2048, help='Synthetic map height')
+    parser.add_argument('--out', dest='outfile', default=None,
+                        help='Write results to this json file')
+    parser.add_argument('--worker', dest='worker', nargs=3, default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.worker:
+        case, n, mapdir = options.worker
+        run_one(case, int(n), mapdir)
+        return
+
+    mapdir = tempfile.mkdtemp()
+    make_maps(mapdir, nx=options.nx, ny=options.ny)
+    results = []
+    print("{0:>8} {1:>10} {2:>10} {3:>14}".format('case', 'n', 'wall (s)', 'peak RSS (MB)'))
+    for case in options.cases:
+        for n in options.sizes:
+            out = subprocess.check_output([sys.executable, __file__, '--worker', case, str(n), mapdir])
+            res = json.loads(out.decode().strip().splitlines()[-1])
+            results.append(res)
+            if 'skipped' in res:
+                print("{case:>8} {n:>10d} skipped: {skipped}".format(**res))
+                continue
+            print("{case:>8} {n:>10d} {wall_s:>10.3f} {peak_rss_mb:>14.1f}".format(**res))
+    if options.outfile:
+        with open(options.outfile, 'w') as f:
+            json.dump({'versions': versions(), 'map_shape': [options.ny, options.nx], 'results': results},
+                      f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,20 +7,218 @@ NE2001 for extragalactic work.
 """
 
 
-from astropy.constants import kpc, c, au
-from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.wcs import WCS
-import astropy.units as u
+# astropy and scipy are imported where they are needed, so that importing this module is quick
 import numpy as np
 import os
 import logging
-from scipy.special import gamma
+import weakref
+from collections import OrderedDict
+from lib.cache import CubeCache
+from lib.timing import timed, stage
 
 __author__ = ['Paul Hancock', 'Elliott Charlton']
 __date__ = '2020-03-06'
 
 SECONDS_PER_YEAR = 3600 * 24 * 365.25
+# These are numpy scalars (like the astropy.constants values) so that float32 map data are promoted to float64
+KPC = np.float64(3.0856775814913675e+19)  # m, as astropy.constants.kpc
+C = np.float64(299792458.0)  # m/s, as astropy.constants.c
+
+# gamma(-β/2) and gamma(β/2), keyed on β. The Kolmogorov value is precomputed so that
+# scipy is only needed for other spectral indices.
+_GAMMA = {11 / 3: (3.6434068375288806, 0.9406558582567717)}
+
+
+def _gamma_pair(beta):
+    """
+    :param beta: spectral index
+    :return: gamma(-beta/2), gamma(beta/2)
+    """
+    if beta not in _GAMMA:
+        from scipy.special import gamma
+        _GAMMA[beta] = (float(gamma(-beta / 2)), float(gamma(beta / 2)))
+    return _GAMMA[beta]
+
+# Maps that have been opened in this process, keyed on absolute path.
+# Each file is opened once and the (read only) memory mapped data is shared by every SM instance,
+# and by any worker processes that are forked after the map was loaded.
+_MAPS = {}
+
+
+def load_map(filename):
+    """
+    Open a FITS map, or return the copy that is already open.
+    :param filename: FITS image
+    :return: header, wcs, data
+    """
+    key = os.path.abspath(filename)
+    if key not in _MAPS:
+        # the memory map stays valid after the file is closed, for as long as the data are referenced
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        with fits.open(filename, memmap=True, ignore_missing_end=True) as hdulist:
+            header = hdulist[0].header
+            data = hdulist[0].data
+        data.flags.writeable = False
+        _MAPS[key] = (header, WCS(header), data)
+    return _MAPS[key]
+
+
+def load_lookup(filename):
+    """
+    Load a lookup grid created by make_lookup, or return the copy that is already loaded.
+    :param filename: .npy file
+    :return: memory mapped grid
+    """
+    key = os.path.abspath(filename)
+    if key not in _MAPS:
+        _MAPS[key] = np.load(filename, mmap_mode='r')
+    return _MAPS[key]
+
+
+# Rotation from FK5 (J2000) to galactic unit vectors, calculated by astropy on first use
+_FK5_TO_GALACTIC = None
+
+
+def fk5_to_galactic(ra, dec):
+    """
+    Convert FK5 (J2000) coordinates to galactic with a single rotation, rather than
+    going through the astropy frame machinery for every set of positions.
+    :param ra: right ascension in degrees
+    :param dec: declination in degrees
+    :return: l, b in degrees
+    """
+    global _FK5_TO_GALACTIC
+    if _FK5_TO_GALACTIC is None:
+        from astropy.coordinates import SkyCoord
+        import astropy.units as u
+        # the galactic unit vectors of the fk5 x, y, and z axes are the columns of the rotation
+        axes = SkyCoord([0., 90., 0.] * u.degree, [0., 0., 90.] * u.degree, frame='fk5')
+        _FK5_TO_GALACTIC = axes.galactic.cartesian.xyz.value
+    ra = np.radians(np.atleast_1d(np.asarray(ra, dtype=np.float64)))
+    dec = np.radians(np.atleast_1d(np.asarray(dec, dtype=np.float64)))
+    cos_dec = np.cos(dec)
+    x, y, z = np.dot(_FK5_TO_GALACTIC, [cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+    l = np.degrees(np.arctan2(y, x)) % 360.
+    b = np.degrees(np.arcsin(np.clip(z, -1., 1.)))
+    return l, b
+
+
+# ways of sampling the Hα map, see SM and interpolate
+INTERP_KINDS = ('nearest', 'bilinear', 'bicubic')
+
+
+def _cubic_weights(t, a=-0.5):
+    """
+    Weights for the four pixels at offsets -1, 0, 1, 2 from the cubic convolution
+    kernel of Keys (1981).
+    :param t: fractional offset from pixel 0, in [0, 1)
+    :param a: kernel parameter
+    :return: list of four weight arrays
+    """
+    t1 = 1 + t
+    t2 = 1 - t
+    t3 = 2 - t
+    w0 = ((a * t1 - 5 * a) * t1 + 8 * a) * t1 - 4 * a
+    w1 = ((a + 2) * t - (a + 3)) * t * t + 1
+    w2 = ((a + 2) * t2 - (a + 3)) * t2 * t2 + 1
+    w3 = ((a * t3 - 5 * a) * t3 + 8 * a) * t3 - 4 * a
+    return [w0, w1, w2, w3]
+
+
+def interpolate(data, x, y, kind='bilinear'):
+    """
+    Sample an image at fractional pixel coordinates.
+    Positions are done a block at a time, with a single gather for all of the kernel taps.
+    Several images of the same shape (eg a map and its errors) can be sampled at once, in which case
+    the pixel indices and weights are calculated once and used for all of them.
+    Pixels beyond the edge of the image take the value of the nearest edge pixel.
+    When used on an error map the errors are interpolated in the same way as the data,
+    ie they are treated as being correlated between neighbouring pixels.
+    The bicubic kernel has negative lobes, so the result is clipped to the range of the
+    pixels that it uses, which stops it overshooting (eg going negative) next to bright pixels.
+    :param data: 2d image, or a list of 2d images with the same shape
+    :param x: pixel coordinates (0 based, pixel centres at integer values)
+    :param y: pixel coordinates
+    :param kind: 'bilinear' or 'bicubic'
+    :return: interpolated values, or a list of them if data is a list
+    """
+    images = list(data) if isinstance(data, (list, tuple)) else [data]
+    ny, nx = images[0].shape
+    shape = np.shape(x)
+    x = np.ravel(np.asarray(x, dtype=np.float64))
+    y = np.ravel(np.asarray(y, dtype=np.float64))
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    tx = x - x0
+    ty = y - y0
+    x0 = x0.astype(np.int64)
+    y0 = y0.astype(np.int64)
+    if kind == 'bilinear':
+        offsets = [0, 1]
+        wx = [1 - tx, tx]
+        wy = [1 - ty, ty]
+    elif kind == 'bicubic':
+        offsets = [-1, 0, 1, 2]
+        wx = _cubic_weights(tx)
+        wy = _cubic_weights(ty)
+    else:
+        raise ValueError("kind must be one of 'bilinear', 'bicubic'")
+    offsets = np.array(offsets)[:, None]
+    wx = np.array(wx)
+    wy = np.array(wy)
+    flat = [np.ravel(image) for image in images]
+    results = [np.empty(x.shape) for _ in images]
+    # work on blocks of positions so that the (taps x taps x block) arrays stay small
+    step = 2 ** 16
+    for i in range(0, len(x), step):
+        block = slice(i, i + step)
+        xs = np.clip(x0[block] + offsets, 0, nx - 1)
+        rows = np.clip(y0[block] + offsets, 0, ny - 1) * nx
+        # index of every tap, with shape (y tap, x tap, position)
+        idx = rows[:, None, :] + xs[None, :, :]
+        for image, result in zip(flat, results):
+            pix = image[idx]
+            value = np.einsum('ik,jk,ijk->k', wy[:, block], wx[:, block], pix)
+            if kind == 'bicubic':
+                value = np.clip(value, pix.min(axis=(0, 1)), pix.max(axis=(0, 1)))
+            result[block] = value
+    results = [result.reshape(shape) for result in results]
+    return results if isinstance(data, (list, tuple)) else results[0]
+
+
+def close_maps():
+    """
+    Forget all of the maps that have been loaded.
+    Existing SM instances keep their references, new instances will reload from disk.
+    """
+    _MAPS.clear()
+
+
+class Positions(object):
+    """
+    A set of sky positions that have been resolved against the maps of an SM instance.
+    Holds everything that depends only on position (galactic coords, pixel indices,
+    Hα samples and screen distance) so that it is computed once per catalogue.
+    Create these with SM.resolve(), and pass them to any of the SM.get_* methods.
+
+    :param l: galactic longitude in degrees
+    :param b: galactic latitude in degrees
+    """
+    def __init__(self, l, b):
+        self.l = np.atleast_1d(np.asarray(l, dtype=np.float64))
+        self.b = np.atleast_1d(np.asarray(b, dtype=np.float64))
+        self.x = self.y = None
+        self.iha = self.err_iha = None
+        self.distance = None
+
+    @property
+    def shape(self):
+        return self.l.shape
+
+    def __len__(self):
+        return len(self.l)
+
 
 class SM(object):
     """
@@ -30,8 +228,13 @@ class SM(object):
     :param d: distance in kpc
     :param v: in m/s
     :param log:
+    :param lookup: lookup grid created by make_lookup, used instead of the WCS projection
+    :param interp: how to sample the Hα maps, one of 'nearest', 'bilinear', 'bicubic'
+    :param cache: directory or CubeCache for cubes of the derived quantities on the Hα pixel grid.
+                  Only used for nearest pixel sampling of the maps (no lookup) with ssize=0.
     """
-    def __init__(self, ha_file, err_file=None, nu=185e6, log=None, d=None, v=10e3):
+    def __init__(self, ha_file, err_file=None, nu=185e6, log=None, d=None, v=10e3, lookup=None,
+                 interp='nearest', cache=None):
 
         if log is None:
             logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
@@ -43,45 +246,267 @@ class SM(object):
         # define some of the constants that we need
         # i'm saving these here to allow for different instances to have different values
         self.nu = nu  # Hz
-        self.kpc = kpc.value  # in m
+        self.kpc = KPC  # in m
         self.t4 = 0.8  # t/1e4 K
         self.lo = 1e18/(self.kpc*1e-3)  # 1e18m expressed in pc (also armstrong_electron_1985 !)
         self.eps = 1
         self.D = d  # kpc - distance to the screen
-        self.c = c.value
+        self.c = C
         self.beta = 11/3
         self.re = 2.817e-15  # m
         self.v = v  # relative velocity of source/observer in m/s
         self.file = ha_file
         self.err_file = err_file
+        self.lookup_file = lookup
+        if interp not in INTERP_KINDS:
+            raise ValueError("interp must be one of {0}".format(list(INTERP_KINDS)))
+        self.interp = interp
+        if cache is not None and not isinstance(cache, CubeCache):
+            cache = CubeCache(cache)
+        self.cache = cache
+        # cubes that have been opened by this instance, keyed on the cache key
+        self._cubes = {}
+        # cache keys, keyed on the cube parameters, so that the maps are only checksummed once
+        # (these are kept when pickling, so worker processes can open a cube without hashing the maps)
+        self._cube_keys = {}
         self._load_file()
+        # the most recently resolved (position, Positions) pair
+        self._resolved = (None, None, None)
 
     def _load_file(self):
-        self.hdu = fits.getheader(self.file, ignore_missing_end=True)
-        self.wcs = WCS(self.hdu)
-        self.data = fits.open(self.file, memmap=True, ignore_missing_end=True)[0].data
+        self.hdu, self.wcs, self.data = load_map(self.file)
         if self.err_file:
-            self.err_hdu = fits.getheader(self.err_file, ignore_missing_end=True)
-            self.err_wcs = WCS(self.err_hdu)
-            self.err_data = fits.open(self.err_file, memmap=True, ignore_missing_end=True)[0].data
+            self.err_hdu, self.err_wcs, self.err_data = load_map(self.err_file)
+        else:
+            self.err_hdu = self.err_wcs = self.err_data = None
+        if self.lookup_file:
+            self.lookup = load_lookup(self.lookup_file)
         else:
-            self.err_hud = self.err_wcs = self.err_data = None
+            self.lookup = None
 
         return
 
-    def get_distance(self, position):
+    def __getstate__(self):
+        # don't pickle the maps, they are reloaded (or shared) via load_map in the new process
+        state = self.__dict__.copy()
+        for key in ['hdu', 'wcs', 'data', 'err_hdu', 'err_wcs', 'err_data', 'lookup']:
+            state.pop(key, None)
+        state['_resolved'] = (None, None, None)
+        state['_cubes'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_file()
+
+    def resolve(self, position):
         """
-        :param position: sky position
+        Resolve a set of sky positions against the maps of this instance.
+        The result for the most recent SkyCoord is remembered, so that repeated calls
+        to the get_* methods with the same object do not redo the frame transform,
+        WCS projection, or map lookup. Only a weak reference to the SkyCoord is kept,
+        and the result is recalculated if the screen distance (D) has changed since.
+        :param position: astropy.coordinates.SkyCoord or Positions
+        :return: Positions
+        """
+        if isinstance(position, Positions):
+            return position
+        last, distance, resolved = self._resolved
+        if last is not None and last() is position and distance == self.D:
+            return resolved
+        with stage('SM.frame', len(position)):
+            gal = position.galactic
+            l, b = gal.l.degree, gal.b.degree
+        resolved = self._resolve_lb(l, b)
+        self._resolved = (weakref.ref(position), self.D, resolved)
+        return resolved
+
+    def resolve_lb(self, l, b):
+        """
+        Resolve galactic positions that are given as plain arrays, without creating a SkyCoord.
+        The result can be passed to any of the get_* methods in place of a SkyCoord.
+        :param l: galactic longitude in degrees
+        :param b: galactic latitude in degrees
+        :return: Positions
+        """
+        return self._resolve_lb(l, b)
+
+    def resolve_radec(self, ra, dec):
+        """
+        Resolve FK5 (J2000) positions that are given as plain arrays, without creating a SkyCoord.
+        The conversion to galactic coordinates is a single vectorised rotation.
+        :param ra: right ascension in degrees
+        :param dec: declination in degrees
+        :return: Positions
+        """
+        with stage('SM.frame', np.size(ra)):
+            l, b = fk5_to_galactic(ra, dec)
+        return self._resolve_lb(l, b)
+
+    @timed('SM.pixels')
+    def _resolve_lb(self, l, b):
+        """
+        Create a Positions object from galactic coordinates and fill in all the
+        position dependent quantities.
+        :param l: galactic longitude in degrees
+        :param b: galactic latitude in degrees
+        :return: Positions
+        """
+        resolved = Positions(l, b)
+        if self.lookup is not None:
+            # x/y are indices into the lookup grid rather than the maps
+            resolved.x, resolved.y = self._get_lookup_pixels(resolved.l, resolved.b)
+            resolved.iha = self.lookup[0, resolved.y, resolved.x]
+            resolved.err_iha = self.lookup[1, resolved.y, resolved.x]
+        elif self.interp != 'nearest':
+            x, y = self.wcs.all_world2pix(resolved.l, resolved.b, 0)
+            resolved.x, resolved.y = self._get_pixels(resolved.l, resolved.b, xy=(x, y))
+            if self.err_data is not None:
+                resolved.iha, resolved.err_iha = interpolate([self.data, self.err_data], x, y, self.interp)
+            else:
+                resolved.iha = interpolate(self.data, x, y, self.interp)
+        else:
+            resolved.x, resolved.y = self._get_pixels(resolved.l, resolved.b)
+            resolved.iha = self.data[resolved.y, resolved.x]
+            if self.err_data is not None:
+                resolved.err_iha = self.err_data[resolved.y, resolved.x]
+        resolved.distance = self._distance(resolved.l, resolved.b)
+        return resolved
+
+    def get_cube(self):
+        """
+        Return the cube of derived quantities for the current parameters, creating it if needed.
+        The cube has one plane per entry of CUBE_PLANES, on the pixel grid of the Hα map, and is
+        calculated for a screen distance of 1 kpc. The values at other distances are found by
+        scaling with the powers given in CUBE_PLANES.
+        Cubes are only used when a cache has been given, and positions are resolved to the
+        nearest pixel of the maps (no lookup grid or interpolation).
+        :return: (planes, ny, nx) array or None
+        """
+        if self.cache is None or self.lookup is not None or self.interp != 'nearest' or self.err_data is None:
+            return None
+        params = {'version': 1, 'planes': list(CUBE_PLANES.keys()), 'nu': self.nu, 'v': self.v,
+                  'beta': self.beta, 't4': self.t4, 'eps': self.eps, 'lo': self.lo, 're': self.re,
+                  'c': self.c, 'kpc': self.kpc, 'year': SECONDS_PER_YEAR}
+        memo = repr(sorted(params.items()))
+        if memo not in self._cube_keys:
+            self._cube_keys[memo] = CubeCache.key(params, [self.file, self.err_file])
+        key = self._cube_keys[memo]
+        if key not in self._cubes:
+            cube = self.cache.get(key)
+            if cube is None:
+                self.log.info("Creating derived quantity cube for nu={0}Hz".format(self.nu))
+                cube = self.cache.put(key, (len(CUBE_PLANES),) + self.data.shape, self._fill_cube)
+            self._cubes[key] = cube
+        return self._cubes[key]
+
+    @timed('SM.cube_build')
+    def _fill_cube(self, cube, rows=256):
+        """
+        Calculate the planes of a derived quantity cube, a block of rows at a time.
+        :param cube: (planes, ny, nx) array to fill
+        :param rows: number of rows per block
+        """
+        ny = self.data.shape[0]
+        for y0 in range(0, ny, rows):
+            y1 = min(ny, y0 + rows)
+            iha = self.data[y0:y1, :]
+            err_iha = self.err_data[y0:y1, :]
+            chain = self._chain(iha, err_iha, np.ones(iha.shape), self.nu, 0, 1)
+            for i, name in enumerate(CUBE_PLANES):
+                cube[i, y0:y1, :] = chain[name]
+
+    def _from_cube(self, position, names, ssize=0):
+        """
+        Read derived quantities from the cube, if there is one.
+        :param position: astropy.coordinates.SkyCoord or Positions
+        :param names: list of planes from CUBE_PLANES
+        :param ssize: source size in deg, the cube only applies to unresolved sources
+        :return: list of arrays, or None if the cube can't be used
+        """
+        if np.any(ssize):
+            return None
+        cube = self.get_cube()
+        if cube is None:
+            return None
+        resolved = self.resolve(position)
+        result = []
+        for name in names:
+            val = cube[list(CUBE_PLANES).index(name), resolved.y, resolved.x].astype(np.float64)
+            power = CUBE_PLANES[name](self.beta)
+            if power != 0:
+                val *= resolved.distance ** power
+            result.append(val)
+        return result
+
+    def resolve_rows(self, y0, y1):
+        """
+        Create a Positions object for every pixel in a block of rows of the Hα map.
+        The map values are read directly, without any projection or interpolation.
+        :param y0: first row
+        :param y1: last row (exclusive)
+        :return: Positions, flattened in the same order as data[y0:y1, :]
+        """
+        nx = self.data.shape[1]
+        y, x = np.mgrid[y0:y1, 0:nx]
+        x = x.ravel()
+        y = y.ravel()
+        # pixel -> world in the native frame of the map, only needed for the distance model
+        l, b = self.wcs.all_pix2world(x, y, 0)
+        resolved = Positions(l, b)
+        resolved.x, resolved.y = x, y
+        resolved.iha = self.data[y0:y1, :].ravel()
+        if self.err_data is not None:
+            resolved.err_iha = self.err_data[y0:y1, :].ravel()
+        resolved.distance = self._distance(resolved.l, resolved.b)
+        return resolved
+
+    def _get_pixels(self, l, b, xy=None):
+        """
+        Convert galactic coordinates into pixel indices within the Hα map.
+        :param l: galactic longitude in degrees
+        :param b: galactic latitude in degrees
+        :param xy: fractional pixel coordinates, if they have already been calculated
+        :return: x, y pixel indices
+        """
+        if xy is None:
+            # The coordinates we request need to be the same as that in the WCS header
+            # for the files in this repo, this currently means galactic coordinates.
+            # pass the arrays straight through, a list of (l, b) tuples is very slow for large catalogues
+            x, y = self.wcs.all_world2pix(l, b, 0)
+        else:
+            x, y = xy
+        x = np.clip(np.floor(x).astype(np.int64), 0, self.hdu['NAXIS1'] - 1)
+        y = np.clip(np.floor(y).astype(np.int64), 0, self.hdu['NAXIS2'] - 1)
+        return x, y
+
+    def _get_lookup_pixels(self, l, b):
+        """
+        Convert galactic coordinates into indices within the lookup grid.
+        The grid is equal-angle in l/b so this is just a scale and floor.
+        :param l: galactic longitude in degrees
+        :param b: galactic latitude in degrees
+        :return: x, y grid indices
+        """
+        _, nb, nl = self.lookup.shape
+        x = np.floor(l * (nl / 360.)).astype(np.int64) % nl
+        y = np.clip(np.floor((b + 90.) * (nb / 180.)).astype(np.int64), 0, nb - 1)
+        return x, y
+
+    def _distance(self, l, b):
+        """
+        :param l: galactic longitude in degrees
+        :param b: galactic latitude in degrees
         :return: Distance to scattering screen in kpc
         """
         if self.D is not None:
-            return np.ones(np.shape(position))*self.D
+            return np.ones(np.shape(l))*self.D
         # TODO: sort out gal_r and find a reference for it
         gal_r = 16.2  # kpc
         sun_r = 8.09  # kpc
         gal_h = 1.   # kpc
-        theta = position.galactic.l.radian # angle from the GC along the plane
-        phi = position.galactic.b.radian   # angle from the GC perp to the plane
+        theta = np.radians(l)  # angle from the GC along the plane
+        phi = np.radians(b)    # angle from the GC perp to the plane
         far_edge = sun_r*np.cos(theta) + np.sqrt(gal_r**2 - (sun_r*np.sin(theta))**2)
         top = (gal_h/2.) / np.abs(np.sin(phi))
         mask = np.where(top > far_edge)
@@ -89,29 +514,29 @@ class SM(object):
         screen_dist[mask] = far_edge[mask]
         return screen_dist/2.
 
+    def get_distance(self, position):
+        """
+        :param position: sky position
+        :return: Distance to scattering screen in kpc
+        """
+        return self.resolve(position).distance.copy()
+
     def get_rf(self, position):
         """
         :param position: Sky position
         :return: Fresnel scale in m
         """
-        return np.sqrt(self.c * self.get_distance(position) * self.kpc / (2 * np.pi * self.nu))
+        return self._rf(self.resolve(position).distance, self.nu)
 
+    @timed('SM.get_halpha')
     def get_halpha(self, position):
         """
         Return the Halpha for a given location on the sky.
         :param position: astropy.coordinates.SkyCoord
         :return:
         """
-        # The coordinates we request need to be the same as that in the WCS header
-        # for the files in this repo, this currently means galactic coordinates.
-        x, y = zip(*self.wcs.all_world2pix(list(zip(position.galactic.l.degree, position.galactic.b.degree)), 0))
-        x = np.int64(np.floor(x))
-        x = np.clip(x, 0, self.hdu['NAXIS1'])
-        y = np.int64(np.floor(y))
-        y = np.clip(y, 0, self.hdu['NAXIS2'])
-        iha = self.data[y, x]
-        err_iha = self.err_data[y, x]
-        return iha, err_iha
+        resolved = self.resolve(position)
+        return resolved.iha.copy(), resolved.err_iha.copy()
 
     def get_sm(self, position):
         """
@@ -120,11 +545,8 @@ class SM(object):
         :param position: astropy.coordinates.SkyCoord
         :return:
         """
-        iha, err_iha = self.get_halpha(position)
-        # Cordes2002
-        sm2 = iha / 198 * self.t4 ** 0.9 * self.eps ** 2 / (1 + self.eps ** 2) * self.lo ** (-2 / 3)
-        err_sm2 = (err_iha / iha) * sm2
-        return sm2, err_sm2
+        resolved = self.resolve(position)
+        return self._sm(resolved.iha, resolved.err_iha)
 
     def get_rdiff(self, position):
         """
@@ -133,14 +555,7 @@ class SM(object):
         :return: parameter r_diff in m
         """
         sm2, err_sm2 = self.get_sm(position)
-        # ^ units are kpc m^{-20/3}, but we want m^{-17/3} so we have to multiply by kpc below
-        # r_diff as per Mcquart & Koay 2013, eq 7a.
-        rdiff = (2 ** (2 - self.beta) * (
-                    np.pi * self.re ** 2 * (self.c / self.nu) ** 2 * self.beta) * sm2 * self.kpc *
-                 gamma(-self.beta / 2) / gamma(self.beta / 2)) ** (1 / (2 - self.beta))
-        err_rdiff = abs((1 / (2 - self.beta)) * (err_sm2 / sm2) * rdiff)
-        return rdiff, err_rdiff
-
+        return self._rdiff(sm2, err_sm2, self.nu)
 
     def get_xi(self, position):
         """
@@ -149,13 +564,12 @@ class SM(object):
         :param position: astropy.coordinates.SkyCoord
         :return: parameter ξ
         """
+        cached = self._from_cube(position, ['xi', 'err_xi'])
+        if cached is not None:
+            return tuple(cached)
         rdiff, err_rdiff = self.get_rdiff(position)
-        # Narayan 1992, uses r_F/r_diff = \xi without explicitly stating that this is being done
-        # Compare Narayan 1992 eq 3.5 with Walker 1998 eq 6
         rf = self.get_rf(position)
-        xi = rf / rdiff
-        err_xi = (err_rdiff/rdiff)*xi
-        return xi, err_xi
+        return self._xi(rf, rdiff, err_rdiff)
 
     def get_theta(self, position):
         """
@@ -163,12 +577,13 @@ class SM(object):
         :param position: astropy.coordinates.SkyCoord
         :return: scattering disk in degrees
         """
-        # See Narayan 1992 eq 4.10 and discussion immediately prior
+        cached = self._from_cube(position, ['theta_r', 'err_theta_r'])
+        if cached is not None:
+            return tuple(cached)
         rdiff, err_rdiff = self.get_rdiff(position)
-        theta = np.degrees((self.c/self.nu)/(2.* np.pi*rdiff))
-        err_theta = np.degrees(err_rdiff / rdiff)*theta
-        return theta, err_theta
+        return self._theta(rdiff, err_rdiff, self.nu)
 
+    @timed('SM.get_m')
     def get_m(self, position, ssize=0):
         """
         calculate the modulation index using parameter ξ for a given sky coord
@@ -176,16 +591,16 @@ class SM(object):
         :param ssize: source size in deg
         :return:
         """
+        cached = self._from_cube(position, ['m', 'err_m'], ssize)
+        if cached is not None:
+            return tuple(cached)
         ssize = np.zeros(len(position)) + ssize
-        xi, err_xi = self.get_xi(position)
-        m = xi ** (-1. / 3.)
-        err_m = (1. / 3.) * (err_xi / xi) * m
-        theta, err_theta = self.get_theta(position)
-        mask = np.where(ssize > theta)
-        m[mask] = m[mask] * (theta[mask] / ssize[mask]) ** (7. / 6.)
-        err_m[mask] = np.sqrt((err_m[mask]/m[mask]) ** (2.0) + ((7. / 6.) * (err_theta[mask] / theta[mask])) ** 2.) * m[mask]
-        return m, err_m
+        rdiff, err_rdiff = self.get_rdiff(position)
+        xi, err_xi = self._xi(self.get_rf(position), rdiff, err_rdiff)
+        theta, err_theta = self._theta(rdiff, err_rdiff, self.nu)
+        return self._m(xi, err_xi, theta, err_theta, ssize)
 
+    @timed('SM.get_timescale')
     def get_timescale(self, position, ssize=0):
         """
         calculate the refractive timescale using parameter ξ for a given sky coord
@@ -194,20 +609,17 @@ class SM(object):
         :param ssize: source size in deg
         :return: timescale in years
         """
-
-        xi, err_xi = self.get_xi(position)
+        cached = self._from_cube(position, ['t0', 'err_t0'], ssize)
+        if cached is not None:
+            return tuple(cached)
         ssize = np.zeros(len(position)) + ssize
+        rdiff, err_rdiff = self.get_rdiff(position)
         rf = self.get_rf(position)
-        tref = rf * xi / self.v / SECONDS_PER_YEAR
-        err_tref = (err_xi/xi)*tref
-        ssize = np.zeros(len(xi)) + ssize
-        # timescale is longer for 'large' sources
-        theta, err_theta = self.get_theta(position)
-        large = np.where(ssize > theta)
-        tref[large] = tref[large] * ssize[large] / theta[large]
-        err_tref[large] = tref[large] * np.sqrt((err_tref[large]/tref[large])**2.  + (err_theta[large]/theta[large])**2.)
-        return tref, err_tref
+        xi, err_xi = self._xi(rf, rdiff, err_rdiff)
+        theta, err_theta = self._theta(rdiff, err_rdiff, self.nu)
+        return self._timescale(rf, xi, err_xi, theta, err_theta, ssize)
 
+    @timed('SM.get_rms_var')
     def get_rms_var(self, position, ssize=0, nyears=1):
         """
         calculate the expected modulation index observed when measured on nyears timescales
@@ -218,30 +630,498 @@ class SM(object):
         :param ssize: source size in deg
         :return: fractional variability
         """
+        cached = self._from_cube(position, ['m', 'err_m', 't0', 'err_t0'], ssize)
+        if cached is not None:
+            return self._rms_var(*(cached + [nyears]))
         ssize = np.zeros(len(position)) + ssize
-        tref, err_tref = self.get_timescale(position, ssize=ssize)
-        m, err_m = self.get_m(position, ssize=ssize)
-        short = np.where(nyears < tref)
-        m[short] *= (nyears / tref[short])
-        err_m[short] = np.sqrt((err_m[short]/m[short]) ** 2. + (err_tref[short] / tref[short]) ** 2.) * m[short]
-        return m, err_m
+        rdiff, err_rdiff = self.get_rdiff(position)
+        rf = self.get_rf(position)
+        xi, err_xi = self._xi(rf, rdiff, err_rdiff)
+        theta, err_theta = self._theta(rdiff, err_rdiff, self.nu)
+        tref, err_tref = self._timescale(rf, xi, err_xi, theta, err_theta, ssize)
+        m, err_m = self._m(xi, err_xi, theta, err_theta, ssize)
+        return self._rms_var(m, err_m, tref, err_tref, nyears)
 
+    @timed('SM.get_vo')
     def get_vo(self, position):
         """
         Calculate the transition frequency at a given sky location
         :param position:
         :return: Transition frequency in GHz
         """
+        cached = self._from_cube(position, ['nu0'])
+        if cached is not None:
+            return cached[0]
         sm2, _ = self.get_sm(position)
+        return self._vo(sm2, self.resolve(position).distance)
+
+    @timed('SM.compute_all')
+    def compute_all(self, position, ssize=0, nyears=1, workers=1, chunksize=None, pool=None):
+        """
+        Calculate all of the derived quantities for a set of sky positions in a single pass.
+        Intermediate values (sm, r_diff, r_F, ξ, θ) are computed only once.
+        Column names match those written by varcalc.py, the rms1yr columns are for
+        variability on nyears timescales.
+        :param position: astropy.coordinates.SkyCoord or Positions
+        :param ssize: source size in deg
+        :param nyears: timescale of interest
+        :param workers: number of processes to use
+        :param chunksize: number of positions sent to a worker at a time
+        :param pool: a pool from make_pool to use instead of starting a new one (eg when called repeatedly)
+        :return: astropy.table.Table
+        """
+        from astropy.table import Table
+        if workers > 1 or pool is not None:
+            return self._compute_all_pool(position, ssize, nyears, workers, chunksize, pool)
+        resolved = self.resolve(position)
+        cached = self._from_cube(resolved, list(CUBE_PLANES.keys()), ssize)
+        if cached is not None:
+            chain = self._chain_cube(resolved, OrderedDict(zip(CUBE_PLANES.keys(), cached)), nyears)
+        else:
+            ssize = np.zeros(len(resolved)) + ssize
+            chain = self._chain(resolved.iha, resolved.err_iha, resolved.distance, self.nu, ssize, nyears)
+        tab = Table()
+        for name, val in chain.items():
+            tab[name] = val
+        return tab
+
+    def sweep_nu(self, position, nu, ssize=0, nyears=1):
+        """
+        Calculate the derived quantities for a set of sky positions at many frequencies.
+        The position dependent parts (Hα, sm, distance) are computed once and broadcast
+        against the frequencies.
+        :param position: astropy.coordinates.SkyCoord or Positions
+        :param nu: array of frequencies in Hz
+        :param ssize: source size in deg
+        :param nyears: timescale of interest
+        :return: OrderedDict of (position x frequency) arrays, with the same keys as the columns of compute_all.
+                 Columns that don't depend on frequency (eg Halpha, sm, Distance) are read only views
+                 of a single value per position, so they take no extra memory.
+        """
+        resolved = self.resolve(position)
+        nu = np.atleast_1d(np.asarray(nu, dtype=np.float64))[None, :]
+        ssize = (np.zeros(len(resolved)) + ssize)[:, None]
+        chain = self._chain(resolved.iha[:, None], resolved.err_iha[:, None], resolved.distance[:, None],
+                            nu, ssize, nyears)
+        shape = (len(resolved), nu.shape[1])
+        return OrderedDict((name, val if np.shape(val) == shape else np.broadcast_to(val, shape))
+                           for name, val in chain.items())
+
+    def sweep_ssize(self, position, ssize, nyears=1):
+        """
+        Calculate the size dependent quantities for a set of sky positions at many source sizes.
+        The scattering chain (ξ, θ, r_F) is computed once per position and broadcast
+        against the source sizes.
+        :param position: astropy.coordinates.SkyCoord or Positions
+        :param ssize: array of source sizes in deg
+        :param nyears: timescale of interest
+        :return: OrderedDict of (position x size) arrays with keys m, err_m, t0, err_t0, rms1yr, err_rms1yr
+        """
+        resolved = self.resolve(position)
+        ssize = np.atleast_1d(np.asarray(ssize, dtype=np.float64))[None, :]
+        chain = self._chain(resolved.iha[:, None], resolved.err_iha[:, None], resolved.distance[:, None],
+                            self.nu, ssize, nyears)
+        return OrderedDict((name, chain[name]) for name in ['m', 'err_m', 't0', 'err_t0', 'rms1yr', 'err_rms1yr'])
+
+    def make_pool(self, workers):
+        """
+        Start a process pool for compute_all, with a copy of this SM in each worker.
+        The derived quantity cube (if any) is created first so that the workers can share it.
+        :param workers: number of processes
+        :return: concurrent.futures.ProcessPoolExecutor
+        """
+        from concurrent.futures import ProcessPoolExecutor
+        self.get_cube()
+        return ProcessPoolExecutor(max_workers=workers, initializer=_pool_init, initargs=(self,))
+
+    def _compute_all_pool(self, position, ssize, nyears, workers, chunksize, pool=None):
+        """
+        Split the positions into chunks and run compute_all on each chunk in a process pool.
+        Results are returned in the same order as the input positions.
+        """
+        from astropy.table import vstack
+        if isinstance(position, Positions):
+            l, b = position.l, position.b
+        else:
+            gal = position.galactic
+            l, b = np.atleast_1d(gal.l.degree), np.atleast_1d(gal.b.degree)
+        ssize = np.zeros(len(l)) + ssize
+        if chunksize is None:
+            chunksize = max(1000, int(np.ceil(len(l) / (4. * max(1, workers)))))
+        starts = range(0, len(l), chunksize)
+        chunks = [(l[i:i + chunksize], b[i:i + chunksize], ssize[i:i + chunksize], nyears) for i in starts]
+        self.log.debug("Processing {0} positions in {1} chunks with {2} workers".format(len(l), len(chunks), workers))
+        if pool is not None:
+            tables = list(pool.map(_pool_compute_all, chunks))
+        else:
+            with self.make_pool(workers) as pool:
+                tables = list(pool.map(_pool_compute_all, chunks))
+        return vstack(tables, join_type='exact', metadata_conflicts='silent')
+
+    # The methods below implement the physics on plain arrays.
+    # They are shared by the get_* methods and compute_all so that each step is written once.
+    # Arguments can be any shapes that broadcast against each other.
+
+    @timed('SM.chain')
+    def _chain(self, iha, err_iha, distance, nu, ssize, nyears):
+        """
+        Calculate every derived quantity from the position dependent inputs.
+        :param iha: Hα intensity in Rayleighs
+        :param err_iha: error in iha
+        :param distance: distance to the screen in kpc
+        :param nu: freq in Hz
+        :param ssize: source size in deg
+        :param nyears: timescale of interest
+        :return: OrderedDict of arrays, keyed by varcalc column name
+        """
+        sm2, err_sm2 = self._sm(iha, err_iha)
+        rdiff, err_rdiff = self._rdiff(sm2, err_sm2, nu)
+        rf = self._rf(distance, nu)
+        xi, err_xi = self._xi(rf, rdiff, err_rdiff)
+        theta, err_theta = self._theta(rdiff, err_rdiff, nu)
+        m, err_m = self._m(xi, err_xi, theta, err_theta, ssize)
+        tref, err_tref = self._timescale(rf, xi, err_xi, theta, err_theta, ssize)
+        rms, err_rms = self._rms_var(m, err_m, tref, err_tref, nyears)
+        vo = self._vo(sm2, distance)
+        return OrderedDict([('Halpha', iha), ('err_Halpha', err_iha), ('Distance', distance),
+                            ('xi', xi), ('err_xi', err_xi), ('sm', sm2), ('err_sm', err_sm2),
+                            ('m', m), ('err_m', err_m), ('t0', tref), ('err_t0', err_tref),
+                            ('rms1yr', rms), ('err_rms1yr', err_rms),
+                            ('theta_r', theta), ('err_theta_r', err_theta), ('nu0', vo)])
+
+    def _chain_cube(self, resolved, cached, nyears):
+        """
+        As for _chain, but with the expensive quantities taken from a derived quantity cube.
+        :param resolved: Positions
+        :param cached: OrderedDict of the CUBE_PLANES for these positions
+        :param nyears: timescale of interest
+        :return: OrderedDict of arrays, keyed by varcalc column name
+        """
+        sm2, err_sm2 = self._sm(resolved.iha, resolved.err_iha)
+        rms, err_rms = self._rms_var(cached['m'], cached['err_m'], cached['t0'], cached['err_t0'], nyears)
+        chain = OrderedDict([('Halpha', resolved.iha), ('err_Halpha', resolved.err_iha),
+                             ('Distance', resolved.distance), ('xi', cached['xi']), ('err_xi', cached['err_xi']),
+                             ('sm', sm2), ('err_sm', err_sm2)])
+        for name in ['m', 'err_m', 't0', 'err_t0']:
+            chain[name] = cached[name]
+        chain['rms1yr'] = rms
+        chain['err_rms1yr'] = err_rms
+        for name in ['theta_r', 'err_theta_r', 'nu0']:
+            chain[name] = cached[name]
+        return chain
+
+    def _sm(self, iha, err_iha):
+        """
+        :param iha: Hα intensity in Rayleighs
+        :param err_iha: error in iha
+        :return: scintillation measure in kpc m^{-20/3}, and error
+        """
+        # Cordes2002
+        sm2 = iha / 198 * self.t4 ** 0.9 * self.eps ** 2 / (1 + self.eps ** 2) * self.lo ** (-2 / 3)
+        err_sm2 = (err_iha / iha) * sm2
+        return sm2, err_sm2
+
+    @timed('SM.rdiff')
+    def _rdiff(self, sm2, err_sm2, nu):
+        """
+        :param sm2: scintillation measure in kpc m^{-20/3}
+        :param err_sm2: error in sm2
+        :param nu: freq in Hz
+        :return: r_diff in m, and error
+        """
+        # ^ units are kpc m^{-20/3}, but we want m^{-17/3} so we have to multiply by kpc below
+        # r_diff as per Mcquart & Koay 2013, eq 7a.
+        gamma_neg, gamma_pos = _gamma_pair(self.beta)
+        rdiff = (2 ** (2 - self.beta) * (
+                    np.pi * self.re ** 2 * (self.c / nu) ** 2 * self.beta) * sm2 * self.kpc *
+                 gamma_neg / gamma_pos) ** (1 / (2 - self.beta))
+        err_rdiff = abs((1 / (2 - self.beta)) * (err_sm2 / sm2) * rdiff)
+        return rdiff, err_rdiff
+
+    def _rf(self, distance, nu):
+        """
+        :param distance: distance to the screen in kpc
+        :param nu: freq in Hz
+        :return: Fresnel scale in m
+        """
+        return np.sqrt(self.c * distance * self.kpc / (2 * np.pi * nu))
+
+    def _xi(self, rf, rdiff, err_rdiff):
+        """
+        :param rf: Fresnel scale in m
+        :param rdiff: diffractive scale in m
+        :param err_rdiff: error in rdiff
+        :return: ξ, and error
+        """
+        # Narayan 1992, uses r_F/r_diff = \xi without explicitly stating that this is being done
+        # Compare Narayan 1992 eq 3.5 with Walker 1998 eq 6
+        xi = rf / rdiff
+        err_xi = (err_rdiff/rdiff)*xi
+        return xi, err_xi
+
+    def _theta(self, rdiff, err_rdiff, nu):
+        """
+        :param rdiff: diffractive scale in m
+        :param err_rdiff: error in rdiff
+        :param nu: freq in Hz
+        :return: scattering disk in degrees, and error
+        """
+        # See Narayan 1992 eq 4.10 and discussion immediately prior
+        theta = np.degrees((self.c/nu)/(2.* np.pi*rdiff))
+        err_theta = np.degrees(err_rdiff / rdiff)*theta
+        return theta, err_theta
+
+    def _m(self, xi, err_xi, theta, err_theta, ssize):
+        """
+        :param xi: ξ
+        :param err_xi: error in ξ
+        :param theta: scattering disk in deg
+        :param err_theta: error in theta
+        :param ssize: source size in deg
+        :return: modulation index, and error
+        """
+        m = xi ** (-1. / 3.)
+        err_m = (1. / 3.) * (err_xi / xi) * m
+        # modulation is suppressed for sources larger than the scattering disk
+        large = ssize > theta
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m_large = m * (theta / ssize) ** (7. / 6.)
+            err_large = np.sqrt((err_m / m_large) ** (2.0) + ((7. / 6.) * (err_theta / theta)) ** 2.) * m_large
+        return np.where(large, m_large, m), np.where(large, err_large, err_m)
+
+    def _timescale(self, rf, xi, err_xi, theta, err_theta, ssize):
+        """
+        :param rf: Fresnel scale in m
+        :param xi: ξ
+        :param err_xi: error in ξ
+        :param theta: scattering disk in deg
+        :param err_theta: error in theta
+        :param ssize: source size in deg
+        :return: timescale in years, and error
+        """
+        tref = rf * xi / self.v / SECONDS_PER_YEAR
+        err_tref = (err_xi/xi)*tref
+        # timescale is longer for 'large' sources
+        large = ssize > theta
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tref_large = tref * ssize / theta
+            err_large = tref_large * np.sqrt((err_tref/tref_large)**2. + (err_theta/theta)**2.)
+        return np.where(large, tref_large, tref), np.where(large, err_large, err_tref)
+
+    def _rms_var(self, m, err_m, tref, err_tref, nyears):
+        """
+        :param m: modulation index
+        :param err_m: error in m
+        :param tref: timescale in years
+        :param err_tref: error in tref
+        :param nyears: timescale of interest
+        :return: fractional variability, and error
+        """
+        short = nyears < tref
+        with np.errstate(divide='ignore', invalid='ignore'):
+            m_short = m * (nyears / tref)
+            err_short = np.sqrt((err_m/m_short) ** 2. + (err_tref / tref) ** 2.) * m_short
+        return np.where(short, m_short, m), np.where(short, err_short, err_m)
+
+    @timed('SM.vo')
+    def _vo(self, sm2, distance):
+        """
+        :param sm2: scintillation measure in kpc m^{-20/3}
+        :param distance: distance to the screen in kpc
+        :return: Transition frequency in GHz
+        """
         pow = (1 / (2 - self.beta))
+        gamma_neg, gamma_pos = _gamma_pair(self.beta)
         A = (2 ** (2 - self.beta) * (np.pi * self.re ** 2 * self.beta) * sm2 * self.kpc *
-             gamma(-self.beta / 2) / gamma(self.beta / 2)) ** pow
-        D = self.get_distance(position)
-        vo = self.c * (np.sqrt(D*self.kpc/(2*np.pi)) / A)**(1/(0.5 - 2*pow))
+             gamma_neg / gamma_pos) ** pow
+        vo = self.c * (np.sqrt(distance*self.kpc/(2*np.pi)) / A)**(1/(0.5 - 2*pow))
         return vo/1e9
 
 
+# The planes of a derived quantity cube (see SM.get_cube), and the power of the screen distance
+# that each one scales with, as a function of beta.
+# r_F ~ D^1/2 so ξ ~ D^1/2, m ~ ξ^-1/3, and t0 ~ r_F ξ ~ D. θ does not depend on D.
+CUBE_PLANES = OrderedDict([('xi', lambda beta: 0.5),
+                           ('err_xi', lambda beta: 0.5),
+                           ('m', lambda beta: -1. / 6),
+                           ('err_m', lambda beta: -1. / 6),
+                           ('t0', lambda beta: 1.),
+                           ('err_t0', lambda beta: 1.),
+                           ('theta_r', lambda beta: 0.),
+                           ('err_theta_r', lambda beta: 0.),
+                           ('nu0', lambda beta: 0.5 / (0.5 - 2 / (2 - beta)))])
+
+# The SM instance used by each worker process in SM.compute_all
+_POOL_SM = None
+
+
+def _pool_init(sm):
+    global _POOL_SM
+    _POOL_SM = sm
+
+
+def _pool_compute_all(args):
+    l, b, ssize, nyears = args
+    return _POOL_SM.compute_all(_POOL_SM._resolve_lb(l, b), ssize=ssize, nyears=nyears)
+
+
+# Quantities that can be written as all-sky maps by write_sky_maps, keyed by the column names of compute_all,
+# with the FITS unit and a description of each
+SKY_MAPS = OrderedDict([('m', ('', 'modulation index')),
+                        ('err_m', ('', 'error in modulation index')),
+                        ('t0', ('yr', 'timescale')),
+                        ('err_t0', ('yr', 'error in timescale')),
+                        ('theta_r', ('deg', 'scattering disk size')),
+                        ('err_theta_r', ('deg', 'error in scattering disk size')),
+                        ('nu0', ('GHz', 'transition frequency')),
+                        ('Distance', ('kpc', 'distance to scattering screen'))])
+
+# header keys that describe the Hα data rather than the pixel grid, and are not copied to other images
+_DATA_KEYS = ('BUNIT', 'BTYPE', 'DATAMIN', 'DATAMAX', 'BSCALE', 'BZERO', 'BLANK', 'CHECKSUM', 'DATASUM')
+
+
+def _sky_tiles(sm, max_pixels=2 ** 22):
+    """
+    Evaluate the full SM chain on the native pixel grid of the Hα map, a block of rows at a time.
+    :param sm: SM instance
+    :param max_pixels: approximate number of pixels per block
+    :return: generator of (y0, y1, OrderedDict of 2d arrays)
+    """
+    ny, nx = sm.data.shape
+    step = max(1, max_pixels // nx)
+    for y0 in range(0, ny, step):
+        y1 = min(ny, y0 + step)
+        resolved = sm.resolve_rows(y0, y1)
+        chain = sm._chain(resolved.iha, resolved.err_iha, resolved.distance, sm.nu, 0, 1)
+        yield y0, y1, OrderedDict((name, np.reshape(val, (y1 - y0, nx))) for name, val in chain.items())
+
+
+def _empty_image(filename, header, shape, dtype=np.float32):
+    """
+    Create a FITS image on disk without holding the data in memory, and open it for writing.
+    Keys that describe the data of the original image (eg BUNIT, DATAMIN) are not copied.
+    :param filename: output file
+    :param header: header to copy (eg for the WCS)
+    :param shape: image shape
+    :param dtype: data type
+    :return: astropy.io.fits.HDUList opened in update mode
+    """
+    from astropy.io import fits
+    hdu = fits.PrimaryHDU(data=np.zeros((1, 1), dtype=dtype))
+    for key, val in header.items():
+        if key in hdu.header or key in ('', 'COMMENT', 'HISTORY') or key in _DATA_KEYS:
+            continue
+        hdu.header[key] = val
+    hdu.header['NAXIS1'] = shape[1]
+    hdu.header['NAXIS2'] = shape[0]
+    header = hdu.header
+    nbytes = shape[0] * shape[1] * np.dtype(dtype).itemsize
+    header.tofile(filename, overwrite=True)
+    with open(filename, 'rb+') as f:
+        f.seek(len(header.tostring()) + nbytes + (-nbytes % 2880) - 1)
+        f.write(b'\0')
+    return fits.open(filename, mode='update', memmap=True)
+
+
+def write_sky_maps(sm, prefix, names=None, max_pixels=2 ** 22):
+    """
+    Evaluate the SM chain on every pixel of the Hα map and write the results as FITS images,
+    with the same WCS as the Hα map, one file per quantity named <prefix>_<name>.fits.
+    The maps are computed and written a block of rows at a time, so memory use is bounded.
+    Source size is taken to be zero, and rms variability is not included as it depends on nyears.
+    :param sm: SM instance
+    :param prefix: output file prefix
+    :param names: quantities to write, from SKY_MAPS (default all)
+    :param max_pixels: approximate number of pixels to process at once
+    :return: list of files written
+    """
+    if names is None:
+        names = list(SKY_MAPS.keys())
+    files = OrderedDict((name, '{0}_{1}.fits'.format(prefix, name)) for name in names)
+    outputs = OrderedDict()
+    for name, filename in files.items():
+        outputs[name] = _empty_image(filename, sm.hdu, sm.data.shape)
+        unit, description = SKY_MAPS[name]
+        outputs[name][0].header['BUNIT'] = (unit, 'units of ' + description)
+        outputs[name][0].header['BTYPE'] = description
+    try:
+        for y0, y1, tile in _sky_tiles(sm, max_pixels):
+            sm.log.debug("Rows {0}-{1} of {2}".format(y0, y1, sm.data.shape[0]))
+            for name in names:
+                outputs[name][0].data[y0:y1, :] = tile[name]
+    finally:
+        for hdulist in outputs.values():
+            hdulist.close()
+    return list(files.values())
+
+
+def make_lookup(ha_file, err_file, outfile, res=None, log=None):
+    """
+    Resample the Hα and error maps onto an equal-angle grid in galactic coordinates
+    and save them as a single .npy file of shape (2, 180/res, 360/res).
+    The grid can then be passed to SM via lookup=outfile, which avoids the WCS projection
+    for every position.
+    Cell [j, i] covers l = [i*res, (i+1)*res), b = [-90+j*res, -90+(j+1)*res) and takes the
+    value of the map pixel at the cell centre. Positions are therefore snapped to a grid cell
+    rather than a map pixel, and the results differ from the WCS path near pixel edges unless
+    every cell falls within one pixel (as it does for a galactic plate carrée map at the default res).
+    A warning is logged if res is coarser than the map, or the cell edges don't match the pixel edges.
+    :param ha_file: Hα map
+    :param err_file: error map
+    :param outfile: output .npy file
+    :param res: grid resolution in degrees, default is the pixel scale of the Hα map,
+                or a half/quarter of it if that is needed to line the cells up with the pixels
+    :param log:
+    :return: outfile
+    """
+    from astropy.wcs.utils import proj_plane_pixel_scales
+    sm = SM(ha_file, err_file, log=log)
+    scale = float(np.min(proj_plane_pixel_scales(sm.wcs)))
+    ctype = list(sm.wcs.wcs.ctype)
+    if ctype[0].startswith('GLON') and ctype[0].endswith('-CAR') and ctype[1].startswith('GLAT'):
+        # SM._get_pixels takes the floor of the pixel coordinate, so the map "pixels" that it
+        # uses have edges at integer pixel coordinates. These should fall on cell edges, which
+        # start at l=0, b=-90.
+        edge = sm.wcs.all_pix2world([[0., 0.]], 0)[0] + np.array([0., 90.])
+
+        def aligned(r):
+            offsets = np.append(edge, max(r, scale)) / min(r, scale)
+            return np.allclose(offsets, np.round(offsets), atol=1e-6)
+        if res is None:
+            # the largest cells that line up with the pixels
+            res = next((scale / n for n in (1, 2, 4, 8) if aligned(scale / n)), scale)
+        if not aligned(res):
+            sm.log.warning("Lookup cell edges do not line up with the map pixel edges, "
+                           "results will differ from the WCS projection near pixel edges")
+    else:
+        res = scale if res is None else res
+        sm.log.warning("The map is not a galactic plate carrée projection, "
+                       "results will differ from the WCS projection near pixel edges")
+    if res > scale * (1 + 1e-6):
+        sm.log.warning("Lookup resolution {0} deg is coarser than the map pixels ({1} deg), "
+                       "so some map pixels will not be used".format(res, scale))
+    nl = int(round(360. / res))
+    nb = int(round(180. / res))
+    sm.log.info("Creating {0}x{1} lookup grid {2}".format(nb, nl, outfile))
+    grid = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float32, shape=(2, nb, nl))
+    l = (np.arange(nl) + 0.5) * (360. / nl)
+    # work a block of rows at a time to keep memory bounded
+    step = max(1, 2 ** 20 // nl)
+    for j0 in range(0, nb, step):
+        j1 = min(nb, j0 + step)
+        b = -90. + (np.arange(j0, j1) + 0.5) * (180. / nb)
+        bb, ll = np.meshgrid(b, l, indexing='ij')
+        x, y = sm._get_pixels(ll.ravel(), bb.ravel())
+        grid[0, j0:j1, :] = sm.data[y, x].reshape(bb.shape)
+        grid[1, j0:j1, :] = sm.err_data[y, x].reshape(bb.shape)
+    grid.flush()
+    del grid
+    return outfile
+
+
 def test_all_params():
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
     print("Testing with single positions")
     #original map
     #sm = SM(os.path.join('data', 'Halpha_map.fits'), os.path.join('data', 'Halpha_error.fits'), nu=1e8)
@@ -262,6 +1142,8 @@ def test_all_params():
     print("Distance = {0}".format(sm.get_distance(pos)))
 
 def test_multi_pos():
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
     print("Testing with list of positions")
     # original map
     # sm = SM(os.path.join('data', 'Halpha_map.fits'), os.path.join('data', 'Halpha_error.fits'), nu=1e8)
@@ -278,7 +1160,9 @@ def test_multi_pos():
     print("Distance = {0}".format(sm.get_distance(pos)))
 
 def write_multi_pos():
+    from astropy.coordinates import SkyCoord
     from astropy.table import Table, Column
+    import astropy.units as u
     RA=np.append(np.arange(0,360),np.arange(0,360))
     DEC=np.append(np.append(np.append(np.arange(-90,90),np.arange(-90,90)),np.arange(-90,90)),np.arange(-90,90))
     #Original map
@@ -313,6 +1197,8 @@ def write_multi_pos():
 
 
 def test_get_distance_empty_mask():
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
     print("Testing get_distance where the mask is empty")
     sm = SM(os.path.join('data', 'Halpha_map.fits'), os.path.join('data', 'Halpha_error.fits'))
     pos = SkyCoord([0, 0, 0, 12, 16, 20]*u.degree, [0.5, 1, 1.2, 90, 90, -90]*u.degree, frame='galactic')
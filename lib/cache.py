@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+An on disk cache of derived quantity cubes.
+Each cube is a .npy file that is memory mapped when read, and is identified by a key
+that is a hash of the parameters used to make it and the checksums of the input maps.
+The least recently used cubes are removed when the total size exceeds a limit.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+# When no size limit is given, the cache holds this many cubes (of the size of the largest cube present)
+DEFAULT_CUBES = 4
+
+# Checksums of input files, keyed on (path, size, mtime) so that each file is only read once per process
+_CHECKSUMS = {}
+
+
+def file_checksum(filename):
+    """
+    Compute the sha1 checksum of a file.
+    :param filename: file to read
+    :return: hex digest
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    memo = (path, stat.st_size, stat.st_mtime)
+    if memo not in _CHECKSUMS:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2 ** 24), b''):
+                sha.update(block)
+        _CHECKSUMS[memo] = sha.hexdigest()
+    return _CHECKSUMS[memo]
+
+
+class CubeCache(object):
+    """
+    A directory of memory mapped cubes, with least recently used eviction.
+
+    :param directory: where the cubes are stored, created if needed
+    :param max_bytes: maximum total size of the cubes in the directory. The default (None) allows
+                      DEFAULT_CUBES cubes, so a full sky map at four frequencies stays in the cache.
+    """
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def key(params, files=()):
+        """
+        Make a key from a set of parameters and the contents of some input files.
+        :param params: dict of json serialisable parameters
+        :param files: list of input files
+        :return: key (string)
+        """
+        sha = hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8'))
+        for filename in files:
+            sha.update(file_checksum(filename).encode('ascii'))
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, 'cube_{0}.npy'.format(key))
+
+    def get(self, key):
+        """
+        Open a cube from the cache.
+        :param key: cube key
+        :return: read only memory mapped array, or None if the cube is not in the cache
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # the modification time records when the cube was last used
+        os.utime(path, None)
+        return np.load(path, mmap_mode='r')
+
+    def put(self, key, shape, fill, dtype=np.float32):
+        """
+        Create a new cube and add it to the cache.
+        The cube is written to a temporary file and then moved into place, so other
+        processes never see a partial cube.
+        :param key: cube key
+        :param shape: cube shape
+        :param fill: function that is passed the (writeable) cube to fill in
+        :param dtype: data type of the cube
+        :return: read only memory mapped array
+        """
+        path = self.path(key)
+        tmp = '{0}.{1}.tmp'.format(path, os.getpid())
+        cube = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        try:
+            fill(cube)
+            cube.flush()
+            del cube
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict(keep=path)
+        return self.get(key)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used cubes until the cache is within max_bytes.
+        :param keep: a file that should not be removed
+        """
+        cubes = []
+        for name in os.listdir(self.directory):
+            if name.startswith('cube_') and name.endswith('.npy'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                cubes.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in cubes)
+        max_bytes = self.max_bytes
+        if max_bytes is None:
+            max_bytes = DEFAULT_CUBES * max([size for _, size, _ in cubes] + [0])
+        for _, size, path in sorted(cubes):
+            if total <= max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+
+
+def make_cache(directory, max_gb=None):
+    """
+    Create a cache from command line options
+    :param directory: cache directory, or None for no cache
+    :param max_gb: maximum size in GB, or None for the default
+    :return: CubeCache or None
+    """
+    if directory is None:
+        return None
+    return CubeCache(directory, None if max_gb is None else int(max_gb * 2 ** 30))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Read and write catalogues a chunk of rows at a time, so that memory use
+depends on the chunk size and not the size of the catalogue.
+"""
+
+import io
+import os
+import numpy as np
+from astropy.io import ascii, fits
+from astropy.table import Table, MaskedColumn
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+FITS_EXT = ('.fits', '.fit', '.fts')
+CSV_EXT = ('.csv',)
+TEXT_EXT = CSV_EXT + ('.txt', '.dat')
+PARQUET_EXT = ('.parquet', '.pq')
+
+
+def _ext(filename):
+    return os.path.splitext(filename)[1].lower()
+
+
+def read_chunks(filename, chunksize):
+    """
+    Read a table in chunks of rows.
+    FITS binary tables are memory mapped, and csv/ascii tables are parsed incrementally.
+    Other formats (eg VOTable) are read in full and then split.
+    :param filename: input table
+    :param chunksize: number of rows per chunk
+    :return: generator of astropy.table.Table
+    """
+    ext = _ext(filename)
+    if ext in FITS_EXT:
+        with fits.open(filename, memmap=True) as hdulist:
+            data = hdulist[1].data
+            for i in range(0, len(data), chunksize):
+                yield Table(data[i:i + chunksize])
+    elif ext in TEXT_EXT:
+        # The fast reader chunks on bytes, so estimate the size of a row from the start of the file
+        with open(filename, 'rb') as f:
+            head = [f.readline() for _ in range(101)]
+        nbytes = sum(len(line) for line in head[1:]) / max(1, len([line for line in head[1:] if line]))
+        fmt = 'csv' if ext in CSV_EXT else 'basic'
+        for tab in ascii.read(filename, format=fmt, guess=False,
+                              fast_reader={'chunk_size': max(int(nbytes * chunksize), 2 ** 16),
+                                           'chunk_generator': True}):
+            yield tab
+    else:
+        tab = Table.read(filename)
+        for i in range(0, len(tab), chunksize):
+            yield tab[i:i + chunksize]
+
+
+class ChunkWriter(object):
+    """
+    Write a table one chunk of rows at a time.
+    The output format is determined from the file extension: FITS binary table,
+    csv, or parquet (which requires pyarrow). Every chunk must have the same columns.
+    For FITS output the column formats are fixed by the first chunk, and later chunks are
+    converted to them (eg strings are padded) if this can be done without losing data.
+
+    :param filename: output file
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.ext = _ext(filename)
+        self.nrows = 0
+        self._fh = None
+        self._header = None
+        self._dtypes = None
+        self._parquet = None
+        if self.ext not in FITS_EXT + CSV_EXT + PARQUET_EXT:
+            raise ValueError("Cannot stream to {0}, use one of {1}".format(filename, FITS_EXT + CSV_EXT + PARQUET_EXT))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, tab):
+        """
+        Append a chunk of rows to the output
+        :param tab: astropy.table.Table
+        """
+        if self.ext in FITS_EXT:
+            self._write_fits(tab)
+        elif self.ext in CSV_EXT:
+            self._write_csv(tab)
+        else:
+            self._write_parquet(tab)
+        self.nrows += len(tab)
+
+    def _write_csv(self, tab):
+        if self._fh is None:
+            self._fh = open(self.filename, 'w')
+            tab.write(self._fh, format='ascii.csv')
+        else:
+            tab.write(self._fh, format='ascii.no_header', delimiter=',')
+
+    def _write_parquet(self, tab):
+        import pyarrow
+        import pyarrow.parquet
+        table = pyarrow.table({name: np.asarray(tab[name]) for name in tab.colnames})
+        if self._parquet is None:
+            self._parquet = pyarrow.parquet.ParquetWriter(self.filename, table.schema)
+        self._parquet.write_table(table)
+
+    def _conform(self, tab):
+        """
+        Convert the columns of a chunk to the data types of the first chunk.
+        Chunks read from text files can have different types (eg longer strings, or floats
+        where the first chunk had only integers), but the rows of a FITS table have a fixed format.
+        :param tab: astropy.table.Table
+        :return: astropy.table.Table
+        """
+        if tab.colnames != [name for name, _ in self._dtypes]:
+            raise ValueError("Chunk has different columns to the first chunk")
+        out = Table()
+        for name, dtype in self._dtypes:
+            col = tab[name]
+            data = np.asarray(col)
+            if dtype.kind in 'SU':
+                data = data.astype(str)
+                if data.size and np.char.str_len(data).max() > dtype.itemsize // np.dtype(dtype.kind + '1').itemsize:
+                    raise ValueError("Column {0} has longer strings than in the first chunk, "
+                                     "use a larger --chunk or csv/parquet output".format(name))
+                cast = data.astype(dtype)
+            elif data.dtype.kind in 'SU':
+                raise ValueError("Column {0} is text but was numeric in the first chunk".format(name))
+            else:
+                cast = data.astype(dtype)
+                if not np.can_cast(data.dtype, dtype) and \
+                        not np.array_equal(cast.astype(data.dtype), data, equal_nan=data.dtype.kind in 'fc'):
+                    raise ValueError("Column {0} has values that don't fit the {1} format of the first chunk, "
+                                     "use a larger --chunk or csv/parquet output".format(name, dtype))
+            if getattr(col, 'mask', None) is not None and np.any(col.mask):
+                out[name] = MaskedColumn(cast, name=name, mask=col.mask, unit=col.unit)
+            else:
+                out[name] = cast
+                out[name].unit = col.unit
+        return out
+
+    def _write_fits(self, tab):
+        if self._dtypes is None:
+            self._dtypes = [(name, tab[name].dtype) for name in tab.colnames]
+        else:
+            tab = self._conform(tab)
+        hdu = fits.BinTableHDU(tab)
+        # let astropy encode the rows, then copy out just the data section
+        buf = io.BytesIO()
+        hdu.writeto(buf)
+        start = len(fits.PrimaryHDU().header.tostring()) + len(hdu.header.tostring())
+        data = buf.getvalue()[start:start + hdu.header['NAXIS1'] * hdu.header['NAXIS2']]
+        if self._fh is None:
+            self._header = hdu.header
+            self._fh = open(self.filename, 'wb')
+            self._fh.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+            # NAXIS2 is corrected when the file is closed
+            self._fh.write(self._header.tostring().encode('ascii'))
+        else:
+            for key in ['NAXIS1', 'TFIELDS'] + ['TFORM{0}'.format(i + 1) for i in range(self._header['TFIELDS'])]:
+                if hdu.header[key] != self._header[key]:
+                    raise ValueError("Chunk has a different table structure ({0}) to the first chunk".format(key))
+        self._fh.write(data)
+
+    def close(self):
+        """
+        Finish writing the output
+        """
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+        if self._fh is None:
+            return
+        if self.ext in FITS_EXT:
+            # pad the data to a whole number of blocks and fix the number of rows
+            nbytes = self._header['NAXIS1'] * self.nrows
+            self._fh.write(b'\0' * (-nbytes % 2880))
+            self._header['NAXIS2'] = self.nrows
+            self._fh.seek(len(fits.PrimaryHDU().header.tostring()))
+            self._fh.write(self._header.tostring().encode('ascii'))
+        self._fh.close()
+        self._fh = None
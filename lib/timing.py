@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+Opt in timing of the stages of a calculation.
+Functions are wrapped with @timed(name) and blocks of code with `with stage(name):`.
+When timing is enabled every call records the elapsed time and the number of items
+(the size of the first array-like argument, or as given by the caller). When disabled the cost is a single flag check.
+Times are inclusive, so a stage that calls other stages includes their time.
+
+Timing is enabled by setting the environment variable SM2017_TIMING=1, or by calling enable().
+Only the stages run in the current process are recorded, so work done in a process pool is not included.
+"""
+
+import functools
+import json
+import os
+import time
+from collections import OrderedDict
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+_ENABLED = os.environ.get('SM2017_TIMING', '0') not in ('', '0')
+
+# name -> [calls, total time, min time, max time, items]
+_STATS = OrderedDict()
+
+
+def enable(on=True):
+    """
+    Turn timing on or off
+    :param on: True to enable timing
+    """
+    global _ENABLED
+    _ENABLED = bool(on)
+
+
+def enabled():
+    """
+    :return: True if timing is enabled
+    """
+    return _ENABLED
+
+
+def reset():
+    """
+    Forget all of the recorded timings
+    """
+    _STATS.clear()
+
+
+def record(name, elapsed, items=0):
+    """
+    Add a single measurement to the registry
+    :param name: stage name
+    :param elapsed: time in seconds
+    :param items: number of items processed
+    """
+    stats = _STATS.get(name)
+    if stats is None:
+        _STATS[name] = [1, elapsed, elapsed, elapsed, items]
+        return
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = min(stats[2], elapsed)
+    stats[3] = max(stats[3], elapsed)
+    stats[4] += items
+
+
+def _size(args):
+    """
+    :return: the number of elements in the first argument that has a shape, or zero
+    """
+    for arg in args:
+        shape = getattr(arg, 'shape', None)
+        if shape is not None:
+            size = 1
+            for n in shape:
+                size *= n
+            return size
+    return 0
+
+
+def timed(name, size=None):
+    """
+    Decorator that records the time taken by each call to a function
+    :param name: stage name
+    :param size: function that returns the number of items processed, given the return value
+                 of the decorated function. Default is the size of the first array-like argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                elapsed = time.perf_counter() - start
+                items = _size(args) if size is None or result is None else size(result)
+                record(name, elapsed, items)
+        return wrapper
+    return decorator
+
+
+class _Stage(object):
+    """
+    Context manager that records the time taken by a block of code
+    """
+    __slots__ = ('name', 'items', 'start')
+
+    def __init__(self, name, items):
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self.start, self.items)
+
+
+class _NoStage(object):
+    """
+    Context manager that does nothing, used when timing is disabled
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, items=0):
+    """
+    Time a block of code:
+        with stage('load'):
+            ...
+    :param name: stage name
+    :param items: number of items processed
+    :return: context manager
+    """
+    if not _ENABLED:
+        return _NO_STAGE
+    return _Stage(name, items)
+
+
+def report():
+    """
+    :return: OrderedDict of stage name -> dict of calls, total_s, mean_s, min_s, max_s, items, items_per_s
+    """
+    result = OrderedDict()
+    for name, (calls, total, tmin, tmax, items) in _STATS.items():
+        result[name] = OrderedDict([('calls', calls), ('total_s', total), ('mean_s', total / calls),
+                                    ('min_s', tmin), ('max_s', tmax), ('items', items),
+                                    ('items_per_s', items / total if total > 0 else 0.)])
+    return result
+
+
+def to_json(filename=None):
+    """
+    :param filename: if given, write the report to this file
+    :return: the report as a json string
+    """
+    text = json.dumps(report(), indent=1)
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(text)
+    return text
+
+
+def log_report(log):
+    """
+    Write the report to a logger, slowest stage first
+    :param log: logging.Logger
+    """
+    stats = report()
+    if not stats:
+        return
+    log.info("{0:>24} {1:>8} {2:>10} {3:>12} {4:>12}".format('stage', 'calls', 'total (s)', 'per call (s)', 'items'))
+    for name, val in sorted(stats.items(), key=lambda x: -x[1]['total_s']):
+        log.info("{0:>24} {calls:>8d} {total_s:>10.4f} {mean_s:>12.6f} {items:>12d}".format(name, **val))
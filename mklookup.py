@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+from astropy.utils.exceptions import AstropyWarning
+
+from lib.SM2017 import make_lookup
+import logging
+import os
+import argparse
+
+# Turn off the stupid warnings that Astropy emits when loading just about any fits file.
+import warnings
+warnings.simplefilter('ignore', category=AstropyWarning)
+
+# configure logging
+logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
+log = logging.getLogger("mklookup")
+log.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resample the Hα maps onto an equal-angle l/b grid "
+                                                 "for use with varcalc.py --lookup")
+    parser.add_argument('--out', dest='outfile', default=None, type=str,
+                        help="Output lookup grid (.npy) [data/Halpha_lookup.npy]")
+    parser.add_argument('--res', dest='res', default=None, type=float,
+                        help="Grid resolution in degrees [the pixel scale of the Hα map, or a fraction of it "
+                             "that lines the grid up with the map pixels]. "
+                             "Positions are snapped to the grid, so results can differ slightly "
+                             "from those without --lookup")
+    results = parser.parse_args()
+
+    # data is stored in the data dir, relative to *this* file
+    datadir = os.path.join(os.path.dirname(__file__), 'data')
+    outfile = results.outfile or os.path.join(datadir, 'Halpha_lookup.npy')
+    make_lookup(ha_file=os.path.join(datadir, 'Halpha_map.fits'),
+                err_file=os.path.join(datadir, 'Halpha_error.fits'),
+                outfile=outfile,
+                res=results.res,
+                log=log)
+    print("Wrote {0}".format(outfile))
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+from astropy.utils.exceptions import AstropyWarning
+
+from lib.SM2017 import SM, write_sky_maps
+import logging
+import os
+import argparse
+
+# Turn off the stupid warnings that Astropy emits when loading just about any fits file.
+import warnings
+warnings.simplefilter('ignore', category=AstropyWarning)
+
+# configure logging
+logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
+log = logging.getLogger("skymaps")
+log.setLevel(logging.INFO)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write all-sky maps of the SM2017 parameters on the pixel grid "
+                                                 "of the Hα map")
+
+    group1 = parser.add_argument_group('Output parameter selection')
+    group1.add_argument('--mod', dest='m', action='store_true', default=False,
+                        help='Modulation index (fraction)')
+    group1.add_argument('--timescale', dest='t0', action='store_true', default=False,
+                        help='Timescale of variability (years)')
+    group1.add_argument('--theta', dest='theta', action='store_true', default=False,
+                        help='Scattering disk size (deg)')
+    group1.add_argument('--nuzero', dest='nuzero', action='store_true', default=False,
+                        help='Transition frequency (GHz)')
+    group1.add_argument('--dist', dest='dist', action='store_true', default=False,
+                        help='Model distance (kpc)')
+    group1.add_argument('--all', dest='do_all', action='store_true', default=False,
+                        help='All of the above (default if nothing is selected)')
+
+    group2 = parser.add_argument_group('Output')
+    group2.add_argument('--out', dest='prefix', default='SM2017', type=str,
+                        help="Prefix for output files, which are <prefix>_<param>.fits [SM2017]")
+    group2.add_argument('--block', dest='block', default=2 ** 22, type=int,
+                        help="Number of pixels to process at a time [4194304]")
+    group2.add_argument('--debug', dest='debug', action='store_true', default=False,
+                        help='Debug mode (default False)')
+
+    group3 = parser.add_argument_group('Input parameter settings')
+    group3.add_argument('--freq', dest='frequency', default=185, type=float,
+                        help="Frequency in MHz")
+    group3.add_argument('--dist_in', dest='dist_in', type=float, default=None,
+                        help="Distance to scattering screen in kpc")
+    group3.add_argument('--vel', dest='velocity', default=10, type=float,
+                        help="Relative motion of screen and observer in km/s")
+
+    results = parser.parse_args()
+
+    if results.debug:
+        log.setLevel(logging.DEBUG)
+
+    if results.do_all or not any([results.m, results.t0, results.theta, results.nuzero, results.dist]):
+        results.m = results.t0 = results.theta = results.nuzero = results.dist = True
+
+    names = []
+    for flag, params in [(results.m, ['m', 'err_m']),
+                         (results.t0, ['t0', 'err_t0']),
+                         (results.theta, ['theta_r', 'err_theta_r']),
+                         (results.nuzero, ['nu0']),
+                         (results.dist, ['Distance'])]:
+        if flag:
+            names.extend(params)
+
+    # data is stored in the data dir, relative to *this* file
+    datadir = os.path.join(os.path.dirname(__file__), 'data')
+    sm = SM(ha_file=os.path.join(datadir, 'Halpha_map.fits'),
+            err_file=os.path.join(datadir, 'Halpha_error.fits'),
+            nu=results.frequency * 1e6,
+            log=log,
+            d=results.dist_in,
+            v=results.velocity * 1e3)
+    for filename in write_sky_maps(sm, results.prefix, names=names, max_pixels=results.block):
+        print("Wrote {0}".format(filename))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, division
+
+"""
+A small HTTP server that answers SM2017 queries from a single SM instance,
+so that the maps are loaded once rather than for every position.
+The server listens on localhost or a Unix socket and handles one request at a time.
+
+GET  /query?ra=10,20&dec=-30,-40[&frame=galactic][&cols=m,t0][&ssize=0][&nyears=1][&format=npz]
+POST /query  with a json body {"ra": [...], "dec": [...], "frame": "fk5", "cols": [...], ...}
+GET  /health
+
+For frame=galactic the ra/dec values are l/b. Column names are those of SM.compute_all, and all
+of them are returned if cols is not given. The response is json (non-finite values are null),
+or a numpy .npz archive with one array per column if format=npz.
+
+eg:
+    curl 'http://127.0.0.1:8017/query?ra=10&dec=-30&cols=m,err_m'
+    curl --unix-socket /tmp/sm.sock 'http://localhost/query?ra=10&dec=-30'
+"""
+
+from lib.SM2017 import SM
+from lib.cache import make_cache
+from astropy.utils.exceptions import AstropyWarning
+from collections import OrderedDict
+import io
+import json
+import logging
+import os
+import argparse
+import numpy as np
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import UnixStreamServer
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import UnixStreamServer
+    from urlparse import urlparse, parse_qs
+
+# Turn off the stupid warnings that Astropy emits when loading just about any fits file.
+import warnings
+warnings.simplefilter('ignore', category=AstropyWarning)
+
+# configure logging
+logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
+log = logging.getLogger("smserver")
+log.setLevel(logging.INFO)
+
+__author__ = ['Paul Hancock', 'Elliott Charlton']
+
+
+def query(sm, params):
+    """
+    Calculate the requested columns for a set of positions
+    :param sm: SM object
+    :param params: dict with ra, dec (lists of degrees) and optionally frame, cols, ssize, nyears
+    :return: OrderedDict of column name -> array
+    """
+    ra = np.atleast_1d(np.asarray(params['ra'], dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(params['dec'], dtype=np.float64))
+    if ra.shape != dec.shape:
+        raise ValueError("ra and dec must be the same length")
+    frame = params.get('frame', 'fk5')
+    if frame == 'galactic':
+        pos = sm.resolve_lb(ra, dec)
+    elif frame == 'fk5':
+        pos = sm.resolve_radec(ra, dec)
+    else:
+        raise ValueError("frame must be fk5 or galactic")
+    tab = sm.compute_all(pos, ssize=params.get('ssize', 0), nyears=params.get('nyears', 1))
+    cols = params.get('cols') or tab.colnames
+    missing = [c for c in cols if c not in tab.colnames]
+    if missing:
+        raise ValueError("Unknown columns {0}, choose from {1}".format(missing, tab.colnames))
+    result = OrderedDict([('ra', ra), ('dec', dec)])
+    for name in cols:
+        result[name] = np.asarray(tab[name])
+    return result
+
+
+def _parse_get(qs):
+    """
+    Convert the query string of a GET request into query parameters
+    """
+    params = {}
+    for key, val in parse_qs(qs).items():
+        val = ','.join(val)
+        if key in ('ra', 'dec'):
+            params[key] = [float(v) for v in val.split(',')]
+        elif key == 'cols':
+            params[key] = val.split(',')
+        elif key in ('ssize', 'nyears'):
+            params[key] = float(val)
+        else:
+            params[key] = val
+    return params
+
+
+def _check_params(params):
+    """
+    Check the types of the query parameters, so that bad queries can be reported to the client
+    :param params: query parameters
+    :return: params
+    """
+    if not isinstance(params, dict):
+        raise ValueError("Query must be a json object")
+    for key in ('ra', 'dec'):
+        if key not in params:
+            raise ValueError("Missing {0}".format(key))
+        values = params[key] if isinstance(params[key], list) else [params[key]]
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+            raise ValueError("{0} must be a number or list of numbers".format(key))
+    for key in ('ssize', 'nyears'):
+        if key in params and (not isinstance(params[key], (int, float)) or isinstance(params[key], bool)):
+            raise ValueError("{0} must be a number".format(key))
+    if 'cols' in params and (not isinstance(params['cols'], list) or
+                             not all(isinstance(c, str) for c in params['cols'])):
+        raise ValueError("cols must be a list of column names")
+    for key in ('frame', 'format'):
+        if key in params and not isinstance(params[key], str):
+            raise ValueError("{0} must be a string".format(key))
+    return params
+
+
+def _tolist(arr):
+    return [v if np.isfinite(v) else None for v in arr.tolist()]
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Answer queries using the SM instance attached to the server
+    """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            self._send(200, 'application/json', json.dumps({'status': 'ok', 'nu': self.server.sm.nu}))
+        elif url.path == '/query':
+            self._answer(lambda: _parse_get(url.query))
+        else:
+            self._error(404, "Unknown path {0}".format(url.path))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/query':
+            self._error(404, "Unknown path {0}".format(url.path))
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = self.rfile.read(length).decode('utf-8')
+        except ValueError as e:
+            self._error(400, "Could not read request: {0}".format(e))
+            return
+
+        def parse():
+            params = _check_params(json.loads(body))
+            params.update(_parse_get(url.query))
+            return params
+        self._answer(parse)
+
+    def _answer(self, parse):
+        """
+        Parse, check, and answer a query. Every failure is reported to the client.
+        :param parse: function that returns the query parameters
+        """
+        try:
+            params = _check_params(parse())
+            result = query(self.server.sm, params)
+        except (KeyError, ValueError, TypeError) as e:
+            self._error(400, "Bad query: {0}".format(e))
+            return
+        except Exception as e:
+            log.exception("Error answering query")
+            self._error(500, "Internal error: {0}".format(e))
+            return
+        if params.get('format', 'json') == 'npz':
+            buf = io.BytesIO()
+            np.savez(buf, **result)
+            self._send(200, 'application/octet-stream', buf.getvalue())
+        else:
+            body = json.dumps(OrderedDict((name, _tolist(val)) for name, val in result.items()))
+            self._send(200, 'application/json', body)
+
+    def _error(self, code, message):
+        self._send(code, 'application/json', json.dumps({'error': message}))
+
+    def _send(self, code, content_type, body):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients don't have an address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, fmt, *args):
+        log.debug("{0} {1}".format(self.address_string(), fmt % args))
+
+
+class UnixHTTPServer(UnixStreamServer):
+    """
+    HTTP over a Unix socket
+    """
+    def get_request(self):
+        request, _ = UnixStreamServer.get_request(self)
+        return request, None
+
+
+def make_server(sm, host='127.0.0.1', port=8017, unix_socket=None):
+    """
+    Create a server that answers queries using the given SM
+    :param sm: SM object
+    :param host: address to listen on
+    :param port: port to listen on
+    :param unix_socket: listen on this Unix socket instead of host/port
+    :return: server, call serve_forever() to start it
+    """
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, QueryHandler)
+    else:
+        server = HTTPServer((host, port), QueryHandler)
+    server.sm = sm
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer SM2017 queries over http, with the maps loaded once")
+
+    group1 = parser.add_argument_group('Server')
+    group1.add_argument('--host', dest='host', default='127.0.0.1', type=str,
+                        help="Address to listen on [127.0.0.1]")
+    group1.add_argument('--port', dest='port', default=8017, type=int,
+                        help="Port to listen on [8017]")
+    group1.add_argument('--socket', dest='socket', default=None, type=str,
+                        help="Listen on this Unix socket instead of host/port")
+    group1.add_argument('--debug', dest='debug', action='store_true', default=False,
+                        help='Debug mode, log every request (default False)')
+
+    group2 = parser.add_argument_group('Input parameter settings')
+    group2.add_argument('--freq', dest='frequency', default=185, type=float,
+                        help="Frequency in MHz")
+    group2.add_argument('--dist_in', dest='dist_in', type=float, default=None,
+                        help="Distance to scattering screen in kpc")
+    group2.add_argument('--vel', dest='velocity', default=10, type=float,
+                        help="Relative motion of screen and observer in km/s")
+    group2.add_argument('--lookup', dest='lookup', default=None, type=str,
+                        help="Use a lookup grid made by mklookup.py instead of the Hα map projection")
+    group2.add_argument('--interp', dest='interp', default='nearest', choices=['nearest', 'bilinear', 'bicubic'],
+                        help="How to sample the Hα map (default nearest)")
+    group2.add_argument('--cubes', dest='cubes', default=None, type=str,
+                        help="Directory for caching the derived quantities on the Hα pixel grid")
+    group2.add_argument('--cube-max-gb', dest='cube_max_gb', default=None, type=float,
+                        help="Maximum total size of the --cubes directory in GB. "
+                             "Default is room for four cubes, each of which is 9x the size of the Hα map")
+
+    results = parser.parse_args()
+
+    if results.debug:
+        log.setLevel(logging.DEBUG)
+
+    # data is stored in the data dir, relative to *this* file
+    datadir = os.path.join(os.path.dirname(__file__), 'data')
+    sm = SM(ha_file=os.path.join(datadir, 'Halpha_map.fits'),
+            err_file=os.path.join(datadir, 'Halpha_error.fits'),
+            nu=results.frequency * 1e6,
+            log=log,
+            d=results.dist_in,
+            v=results.velocity * 1e3,
+            lookup=results.lookup,
+            interp=results.interp,
+            cache=make_cache(results.cubes, results.cube_max_gb))
+    # resolve one position so that everything is loaded before the first query
+    sm.compute_all(sm.resolve_lb([0.], [45.]))
+
+    server = make_server(sm, results.host, results.port, results.socket)
+    log.info("Listening on {0}".format(results.socket or "http://{0}:{1}".format(results.host, results.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if results.socket and os.path.exists(results.socket):
+            os.remove(results.socket)
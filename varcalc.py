@@ -2,27 +2,146 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, division
 
-from astropy.coordinates import SkyCoord
-from astropy.table import Table, Column
-import astropy.units as u
-from astropy.utils.exceptions import AstropyWarning
-
-from lib.SM2017 import SM
+# astropy, numpy, and lib.SM2017 are imported once the arguments have been parsed,
+# so that --help and usage errors don't have to wait for them
+from lib import timing
 import logging
 import os
 import sys
 import argparse
-import numpy as np
-
-# Turn off the stupid warnings that Astropy emits when loading just about any fits file.
+import atexit
+import json
 import warnings
-warnings.simplefilter('ignore', category=AstropyWarning)
+from collections import OrderedDict
 
 # configure logging
 logging.basicConfig(format="%(module)s:%(levelname)s %(message)s")
 log = logging.getLogger("varcalc")
 log.setLevel(logging.INFO)
 
+# varcalc option, and the columns from SM.compute_all that it adds to the output
+COLUMNS = [('halpha', ['Halpha', 'err_Halpha']),
+           ('dist', ['Distance']),
+           ('xi', ['xi', 'err_xi']),
+           ('sm', ['sm', 'err_sm']),
+           ('m', ['m', 'err_m']),
+           ('t0', ['t0', 'err_t0']),
+           ('rms', ['rms1yr', 'err_rms1yr']),
+           ('theta', ['theta_r', 'err_theta_r']),
+           ('nuzero', ['nu0'])]
+
+
+def resolve(sm, lon, lat, frame):
+    """
+    Resolve positions given as arrays of degrees against the SM maps
+    :param sm: SM object
+    :param lon: ra or l
+    :param lat: dec or b
+    :param frame: 'galactic' or 'fk5'
+    :return: Positions
+    """
+    if frame == 'galactic':
+        return sm.resolve_lb(lon, lat)
+    return sm.resolve_radec(lon, lat)
+
+
+def column_degrees(lon, lat, frame):
+    """
+    Convert a pair of coordinate columns into arrays of degrees.
+    Numeric columns are taken to be in degrees unless they have a unit, and other
+    columns (eg sexagesimal strings) are parsed by SkyCoord.
+    :param lon: ra or l column
+    :param lat: dec or b column
+    :param frame: 'galactic' or 'fk5'
+    :return: lon, lat in degrees
+    """
+    import numpy as np
+    import astropy.units as u
+    if np.asarray(lon).dtype.kind in 'iuf' and np.asarray(lat).dtype.kind in 'iuf':
+        # fast path without a SkyCoord
+        return [u.Quantity(col, u.deg).to_value(u.deg) if getattr(col, 'unit', None) is not None
+                else np.asarray(col, dtype=np.float64) for col in (lon, lat)]
+    from astropy.coordinates import SkyCoord
+    pos = SkyCoord(lon, lat, frame=frame, unit=(getattr(lon, 'unit', None) or u.deg,
+                                                getattr(lat, 'unit', None) or u.deg))
+    return pos.spherical.lon.degree, pos.spherical.lat.degree
+
+
+def process_table(tab, sm, results, frame, pool=None):
+    """
+    Calculate the requested parameters for all the positions in a table
+    :param tab: input table
+    :param sm: SM object
+    :param results: parsed command line options
+    :param frame: coordinate frame of the input positions
+    :param pool: process pool from SM.make_pool, shared between calls when streaming chunks
+    :return: output table
+    """
+    from astropy.table import Table, Column
+    ra = tab[results.cols[0]]
+    dec = tab[results.cols[1]]
+    # resolve the positions directly from the arrays of degrees
+    pos = resolve(sm, *column_degrees(ra, dec, frame), frame=frame)
+    # make a new table for writing and copy the ra/dec unless we are appending to the old file
+    if not results.append:
+        tab = Table()
+        tab.add_column(ra)
+        tab.add_column(dec)
+    # calculate everything in one pass, then keep only the requested columns
+    calc = sm.compute_all(pos, workers=results.workers, pool=pool)
+    for dest, names in COLUMNS:
+        if getattr(results, dest):
+            for name in names:
+                tab.add_column(Column(data=calc[name], name=name))
+    return tab
+
+
+def read_positions(pos, cols, chunksize):
+    """
+    Turn the --pos arguments into tables of positions
+    :param pos: list of strings, either ra dec pairs, or '-' to read one pair per line from stdin
+    :param cols: names for the two coordinate columns
+    :param chunksize: number of positions per table when reading from stdin
+    :return: generator of astropy.table.Table
+    """
+    from astropy.table import Table
+    if pos != ['-']:
+        values = [float(v) for v in pos]
+        yield Table([values[0::2], values[1::2]], names=cols)
+        return
+    batch = []
+    for line in sys.stdin:
+        words = line.replace(',', ' ').split()
+        if not words or words[0].startswith('#'):
+            continue
+        if len(words) < 2:
+            raise ValueError("Expected 'ra dec' but got {0!r}".format(line.strip()))
+        batch.append((float(words[0]), float(words[1])))
+        if len(batch) == chunksize:
+            yield Table(rows=batch, names=cols)
+            batch = []
+    if batch:
+        yield Table(rows=batch, names=cols)
+
+
+def write_stdout(tab, ndjson=False, header=True):
+    """
+    Write a table to stdout as csv or as one json object per row
+    :param tab: astropy.table.Table
+    :param ndjson: write json instead of csv
+    :param header: write the csv header
+    """
+    if ndjson:
+        columns = [[v if v == v and abs(v) != float('inf') else None for v in tab[name].tolist()]
+                   for name in tab.colnames]
+        for row in zip(*columns):
+            print(json.dumps(OrderedDict(zip(tab.colnames, row))))
+    elif header:
+        tab.write(sys.stdout, format='ascii.csv')
+    else:
+        tab.write(sys.stdout, format='ascii.no_header', delimiter=',')
+    sys.stdout.flush()
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -60,10 +179,32 @@ if __name__ == "__main__":
                         help="Table of results")
     group2.add_argument('--append', dest='append', action='store_true', default=False,
                         help="Append the data to the input data (write a new file)")
-    group2.add_argument('--pos', dest='pos', default=None, nargs=2, type=float,
-                        help="Single coordinates in ra/dec degrees")
+    group2.add_argument('--pos', dest='pos', default=None, nargs='+', type=str, metavar='RA DEC',
+                        help="Coordinates in ra/dec degrees. Give one or more pairs, or - to read pairs "
+                             "from stdin (one per line). Many positions are written as a csv table to stdout")
+    group2.add_argument('--ndjson', dest='ndjson', action='store_true', default=False,
+                        help="With --pos, write one json object per position instead of csv")
     group2.add_argument('-g', '--galactic', dest='galactic', action='store_true', default=False,
                         help='Interpret input coordinates as l/b instead of ra/dec (default False)')
+    group2.add_argument('--lookup', dest='lookup', default=None, type=str,
+                        help="Use a lookup grid made by mklookup.py instead of the Hα map projection")
+    group2.add_argument('--interp', dest='interp', default='nearest', choices=['nearest', 'bilinear', 'bicubic'],
+                        help="How to sample the Hα map (default nearest)")
+    group2.add_argument('--cubes', dest='cubes', default=None, type=str,
+                        help="Directory for caching the derived quantities on the Hα pixel grid. "
+                             "Repeated runs with the same --freq/--vel are then a single lookup")
+    group2.add_argument('--cube-max-gb', dest='cube_max_gb', default=None, type=float,
+                        help="Maximum total size of the --cubes directory in GB. "
+                             "Default is room for four cubes, each of which is 9x the size of the Hα map")
+    group2.add_argument('--workers', dest='workers', default=1, type=int,
+                        help="Number of processes to use for table input (default 1)")
+    group2.add_argument('--chunk', dest='chunk', default=None, type=int,
+                        help="Read/process/write table input this many rows at a time. "
+                             "Output must be .fits, .csv, or .parquet "
+                             "(not .fits when appending to text input). "
+                             "With --pos -, the number of positions per batch (default 10000)")
+    group2.add_argument('--timing', dest='timing', action='store_true', default=False,
+                        help="Log the time spent in each stage of the calculation")
     group2.add_argument('--debug', dest='debug', action='store_true', default=False,
                         help='Debug mode (default False)')
 
@@ -80,6 +221,10 @@ if __name__ == "__main__":
     if results.debug:
         log.setLevel(logging.DEBUG)
 
+    if results.timing:
+        timing.enable()
+        atexit.register(timing.log_report, log)
+
     if results.do_all:
         results.halpha = results.sm = results.m = results.rms = True
         results.xi = results.t0 = results.theta = results.nuzero = results.fzero = True
@@ -97,6 +242,22 @@ if __name__ == "__main__":
         parser.print_usage()
         sys.exit(0)
 
+    if results.pos and results.pos != ['-']:
+        try:
+            [float(v) for v in results.pos]
+        except ValueError:
+            print("--pos requires pairs of coordinates in degrees, or -")
+            sys.exit(1)
+        if len(results.pos) % 2 != 0:
+            print("--pos requires pairs of coordinates in degrees, or -")
+            sys.exit(1)
+
+    # Turn off the stupid warnings that Astropy emits when loading just about any fits file.
+    from astropy.utils.exceptions import AstropyWarning
+    warnings.simplefilter('ignore', category=AstropyWarning)
+    from lib.SM2017 import SM
+    from lib.cache import make_cache
+
     if results.galactic:
         log.info("Using galactic coordinates")
         frame = 'galactic'
@@ -105,15 +266,33 @@ if __name__ == "__main__":
         frame = 'fk5'
 
     if results.pos:
-        ra, dec = results.pos
-        pos = SkyCoord([ra]*u.degree, [dec]*u.degree, frame=frame)
         log.info(os.path.join(datadir, 'Halpha_error.fits'))
         sm = SM(ha_file=os.path.join(datadir, 'Halpha_map.fits'),
                 err_file=os.path.join(datadir, 'Halpha_error.fits'),
                 nu=nu,
                 log=log,
                 d=d,
-                v=v)
+                v=v,
+                lookup=results.lookup,
+                interp=results.interp,
+                cache=make_cache(results.cubes, results.cube_max_gb))
+        if len(results.pos) > 2 or results.pos == ['-'] or results.ndjson:
+            # many positions: evaluate them a batch at a time and write the results to stdout
+            # one pool of workers for the whole stream
+            pool = sm.make_pool(results.workers) if results.workers > 1 else None
+            try:
+                for i, tab in enumerate(read_positions(results.pos, results.cols, results.chunk or 10000)):
+                    write_stdout(process_table(tab, sm, results, frame, pool),
+                                 ndjson=results.ndjson, header=(i == 0))
+            except ValueError as e:
+                log.error(e)
+                sys.exit(1)
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+            sys.exit(0)
+        ra, dec = [float(v) for v in results.pos]
+        pos = resolve(sm, [ra], [dec], frame)
         if results.halpha:
             logging.debug(sm.get_halpha(pos))
             val,err=sm.get_halpha(pos)
@@ -155,59 +334,43 @@ if __name__ == "__main__":
         if not results.outfile:
             print("Output file is required")
             sys.exit(1)
-        # read the input data
-        tab = Table.read(results.infile)
-        ra = tab[results.cols[0]]
-        dec = tab[results.cols[1]]
-        # create the sky coordinate
-        pos = SkyCoord(ra, dec, unit=(u.deg, u.deg), frame=frame)
+        if results.chunk and results.append:
+            from lib.catalogue import FITS_EXT, TEXT_EXT
+            # the formats of a FITS table are fixed by the first chunk, but the string widths
+            # (and int/float types) of columns read from text depend on the rows in each chunk
+            if os.path.splitext(results.infile)[1].lower() in TEXT_EXT and \
+                    os.path.splitext(results.outfile)[1].lower() in FITS_EXT:
+                log.error("Cannot --append text input to a FITS file with --chunk, use csv or parquet output")
+                sys.exit(1)
         # make the SM object
         sm = SM(ha_file=os.path.join(datadir, 'Halpha_map.fits'),
                 err_file=os.path.join(datadir, 'Halpha_error.fits'),
                 nu=nu,
                 log=log,
                 d=d,
-                v=v)
-        # make a new table for writing and copy the ra/dec unless we are appending to the old file
-        if not results.append:
-            tab = Table()
-            tab.add_column(ra)
-            tab.add_column(dec)
-        else:
+                v=v,
+                lookup=results.lookup,
+                interp=results.interp,
+                cache=make_cache(results.cubes, results.cube_max_gb))
+        if results.append:
             print("Appending results to existing table")
-        if results.halpha:
-            val, err=sm.get_halpha(pos)
-            tab.add_column(Column(data=val, name='Halpha'))
-            tab.add_column(Column(data=err, name='err_Halpha'))
-        if results.dist:
-            val = sm.get_distance(pos)
-            tab.add_column(Column(data=val, name='Distance'))
-        if results.xi:
-            val, err = sm.get_xi(pos)
-            tab.add_column(Column(data=val, name='xi'))
-            tab.add_column(Column(data=err, name='err_xi'))
-        if results.sm:
-            val, err = sm.get_sm(pos)
-            tab.add_column(Column(data=val, name='sm'))
-            tab.add_column(Column(data=err, name='err_sm'))
-        if results.m:
-            val, err = sm.get_m(pos)
-            tab.add_column(Column(data=val, name='m'))
-            tab.add_column(Column(data=err, name='err_m'))
-        if results.t0:
-            val, err = sm.get_timescale(pos)
-            tab.add_column(Column(data=val, name='t0'))
-            tab.add_column(Column(data=err, name='err_t0'))
-        if results.rms:
-            val, err = sm.get_rms_var(pos)
-            tab.add_column(Column(data=val, name='rms1yr'))
-            tab.add_column(Column(data=err, name='err_rms1yr'))
-        if results.theta:
-            val, err = sm.get_theta(pos)
-            tab.add_column(Column(data=val, name='theta_r'))
-            tab.add_column(Column(data=err, name='err_theta_r'))
-        if results.nuzero:
-            val = sm.get_vo(pos)
-            tab.add_column(Column(data=val, name='nu0'))
+        if results.chunk:
+            # stream the input through in chunks and write as we go
+            from lib.catalogue import read_chunks, ChunkWriter
+            print("Writing to {0}".format(results.outfile))
+            # one pool of workers for the whole stream
+            pool = sm.make_pool(results.workers) if results.workers > 1 else None
+            try:
+                with ChunkWriter(results.outfile) as writer:
+                    for tab in read_chunks(results.infile, results.chunk):
+                        writer.write(process_table(tab, sm, results, frame, pool))
+                        log.debug("{0} rows written".format(writer.nrows))
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+            sys.exit(0)
+        # read the input data
+        from astropy.table import Table
+        tab = process_table(Table.read(results.infile), sm, results, frame)
         print("Writing to {0}".format(results.outfile))
         tab.write(results.outfile, overwrite=True)